@@ -0,0 +1,275 @@
+"""Benchmark for the Blinky eyeblink detector pipeline. Runs the stages headless on a video
+(sample_video.avi by default) or on a longer synthetic video made of it, and reports frames per
+second of each stage cold (empty caches) and warm. Results are saved as JSON for comparing
+versions."""
+import sys
+import argparse
+import copy
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+import cv2 as cv
+import numpy as np
+from pathlib import Path
+
+import blinky_app
+import filtering
+from capture import Capture
+from filtering import VideoFiltering, LuminanceFiltering
+from frame import Frame
+from tracking import Tracking
+from results import CsvResultWriter, NpyResultWriter
+
+cascade_file = Path('./haar_cascades/haarcascade_eye.xml')
+input_file = Path('../sample_video.avi')
+
+
+def make_synthetic_video(input_file, repeat, directory):
+    """Writes video of the input repeated given times (MJPG, no decode-heavy long GOP)."""
+    cap = Capture(str(input_file))
+    frames = []
+    while cap.capture_open():
+        if cap.capture_frame() is None:
+            break
+        frames.append(cap.frame.frame.copy())
+    output_file = Path(directory) / (input_file.stem + "_x{}.avi".format(repeat))
+    size = (frames[0].shape[1], frames[0].shape[0])
+    writer = cv.VideoWriter(str(output_file), cv.VideoWriter_fourcc(*'MJPG'), cap.get_fps(), size)
+    for i in range(repeat):
+        for frame in frames:
+            writer.write(frame)
+    writer.release()
+    return output_file
+
+
+def clear_caches():
+    """Empties cascade and lookup table caches for the cold run."""
+    Tracking.cascades.clear()
+    filtering._threshold_table.cache_clear()
+
+
+def timed(function, count):
+    """Runs function and returns result in frames per second and seconds."""
+    start = time.perf_counter()
+    function()
+    duration = time.perf_counter() - start
+    return {'frames': count, 'seconds': duration, 'fps': count / max(duration, 1e-9)}
+
+
+def read_frames(video, max_frames):
+    """Decodes frames to memory for the stage benchmarks."""
+    cap = Capture(str(video))
+    frames = []
+    while cap.capture_open() and len(frames) < max_frames:
+        if cap.capture_frame() is None:
+            break
+        frames.append(copy.deepcopy(cap.frame))
+    return frames
+
+
+def bench_decode(video):
+    """Decoding the whole video."""
+    cap = Capture(str(video))
+    count = 0
+    start = time.perf_counter()
+    while cap.capture_open():
+        if cap.capture_frame() is None:
+            break
+        count += 1
+    duration = time.perf_counter() - start
+    return {'frames': count, 'seconds': duration, 'fps': count / max(duration, 1e-9)}
+
+
+def bench_tracking(frames):
+    """Eye detection and tracking methods, each from a fresh tracker."""
+    results = {}
+    for method in ('haar_classifier', 'haar_roi_classifier', 'template_tracking'):
+        tracker = Tracking()
+        def run():
+            for frame in frames:
+                tracker.frame = frame
+                getattr(tracker, method)(cascadeFile=str(cascade_file), minSize=(24, 54))
+        results[method] = timed(run, len(frames))
+    return results
+
+
+def bench_filters(frames, haar_pt, params):
+    """Each filter of the reference VideoFiltering and LuminanceFiltering separately on the eye
+    area. Input of each stage is prepared before timing."""
+    results = {}
+    blur = (params['blur_val'], params['blur_val'])
+    size = (params['area_x'], params['area_y'])
+    stages = [
+        (VideoFiltering, [
+            ('blur', lambda f: f.blur(blur)),
+            ('brightness_contrast', lambda f: f.brightness_contrast(params['b_val'],
+                                                                    params['c_val'])),
+            ('threshold', lambda f: f.threshold(params['thres_val'])),
+            ('resize', lambda f: f.resize(size)),
+            ('frequencies', lambda f: f.frequencies())]),
+        (LuminanceFiltering, [
+            ('luminance', lambda f: f.luminance()),
+            ('blur', lambda f: f.blur(blur)),
+            ('lut_threshold', lambda f: f.lut_threshold(params['b_val'], params['c_val'],
+                                                        params['thres_val'])),
+            ('resize', lambda f: f.resize(size)),
+            ('frequencies', lambda f: f.frequencies())])]
+
+    for filters, filter_stages in stages:
+        name = filters.__name__
+        # Stage inputs, cropped eye areas at first
+        inputs = []
+        for frame in frames:
+            filt = filters(copy.deepcopy(frame))
+            filt.crop_roi(haar_pt, params['pad_val'])
+            inputs.append(filt.frame.frame)
+        results[name] = {}
+        filt = filters()
+        for stage, function in filter_stages:
+            outputs = []
+            start = time.perf_counter()
+            for img in inputs:
+                filt.frame = Frame(img)
+                function(filt)
+                outputs.append(filt.frame.frame.copy())
+            duration = time.perf_counter() - start
+            results[name][stage] = {'frames': len(inputs), 'seconds': duration,
+                                    'fps': len(inputs) / max(duration, 1e-9)}
+            inputs = outputs
+    return results
+
+
+def bench_allocations(frames, haar_pt, params):
+    """Memory allocated per frame by the whole output filtering chain of the reference
+    VideoFiltering and LuminanceFiltering, measured with tracemalloc as the peak above the memory
+    in use before the frame. Reused buffers are allocated on the first frame, so it is left out."""
+    def reference(filt):
+        filt.crop_roi(haar_pt, params['pad_val'])
+        filt.blur((params['blur_val'], params['blur_val']))
+        filt.brightness_contrast(params['b_val'], params['c_val'])
+        filt.threshold(params['thres_val'])
+        filt.resize((params['area_x'], params['area_y']))
+        filt.frequencies()
+
+    def luminance(filt):
+        filt.process(params, haar_pt)
+        filt.frequencies()
+
+    results = {}
+    for filters, chain in ((VideoFiltering, reference), (LuminanceFiltering, luminance)):
+        filt = filters()
+        allocated = []
+        tracemalloc.start()
+        for frame in frames:
+            filt.frame = Frame(frame.frame, frame.frame_num, frame.frame_time)
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            chain(filt)
+            allocated.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+        allocated = allocated[1:]
+        results[filters.__name__] = {'mean_bytes': int(np.mean(allocated)),
+                                     'max_bytes': int(np.max(allocated))}
+    return results
+
+
+def bench_output(count, directory):
+    """Writing frame data rows with CSV and NumPy writers."""
+    rows = [(i, i * 2.0, 8000 + i % 100) for i in range(count)]
+    results = {}
+    for name, writer in (('csv', CsvResultWriter(Path(directory) / 'bench.csv')),
+                         ('npy', NpyResultWriter(Path(directory) / 'bench_npy'))):
+        def run():
+            for row in rows:
+                writer.append(row)
+            writer.close()
+        results[name] = timed(run, count)
+    return results
+
+
+def bench_pipeline(video, haar_pt, params):
+    """Whole command line analysis of the video."""
+    data_out = []
+    start = time.perf_counter()
+    blinky_app.analyze_chunk(video, params, cascade_file, haar_pt, 24, None, data_out=data_out)
+    duration = time.perf_counter() - start
+    return {'frames': len(data_out), 'seconds': duration,
+            'fps': len(data_out) / max(duration, 1e-9)}
+
+
+def run_benchmark(video, params, stage_frames, tracking_frames, directory):
+    """Runs all the benchmarks once."""
+    stats = Tracking.get_stats()
+    frames = read_frames(video, stage_frames)
+    tracker = Tracking(frames[0])
+    tracker.haar_classifier(cascadeFile=str(cascade_file))
+    haar_pt = tracker.get_tracking_point('haar')
+    return {'decode': bench_decode(video),
+            'tracking': bench_tracking(frames[:tracking_frames]),
+            'filtering': bench_filters(frames, haar_pt, params),
+            'allocations': bench_allocations(frames, haar_pt, params),
+            'output': bench_output(len(frames), directory),
+            'pipeline': bench_pipeline(video, haar_pt, params),
+            'cascade': {key: value - stats[key] for key, value in Tracking.get_stats().items()}}
+
+
+def print_results(name, results, indent=0):
+    """Prints fps of the results tree."""
+    for key, value in results.items():
+        if isinstance(value, dict) and 'fps' in value:
+            print("{}{:<24}{:>10.0f} fps".format(' ' * indent, key, value['fps']))
+        elif isinstance(value, dict):
+            print("{}{}".format(' ' * indent, key))
+            print_results(key, value, indent + 2)
+        else:
+            print("{}{:<24}{:>10}".format(' ' * indent, key, value))
+
+
+def main():
+    global input_file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', help='define input video (default sample_video.avi)')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='define output json-file')
+    parser.add_argument('-r', '--repeat', type=int, default=0,
+                        help='benchmark also synthetic video of the input repeated given times')
+    parser.add_argument('--stage-frames', type=int, default=1000,
+                        help='frames for the filter stage benchmarks')
+    parser.add_argument('--tracking-frames', type=int, default=100,
+                        help='frames for the tracking benchmarks')
+    args = parser.parse_args()
+    if args.input:
+        input_file = Path(args.input)
+    if not input_file.exists():
+        sys.exit("Video file not found!")
+
+    params = dict(blinky_app.DEFAULT_PARAMETERS)
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'opencv': cv.__version__,
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'parameters': params,
+              'videos': {}}
+
+    with tempfile.TemporaryDirectory() as directory:
+        videos = [input_file]
+        if args.repeat > 1:
+            videos.append(make_synthetic_video(input_file, args.repeat, directory))
+        for video in videos:
+            print("\nBenchmarking '{}'".format(video.name))
+            clear_caches()
+            cold = run_benchmark(video, params, args.stage_frames, args.tracking_frames, directory)
+            warm = run_benchmark(video, params, args.stage_frames, args.tracking_frames, directory)
+            report['videos'][video.name] = {'cold': cold, 'warm': warm}
+            print_results(video.name, {'cold': cold, 'warm': warm})
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, default=lambda value: value.item())
+    print("\nResults saved to '{}'".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Online blink detection from the white pixel count of the analysis."""
+from results import CsvResultWriter
+
+
+class BlinkDetector:
+    """Detects blinks from the white pixel count one frame at a time. Baseline and its deviation are
+    running averages, so each frame takes constant time and memory. Closing eye decreases the count:
+    blink starts when the count drops below the onset level and ends when it recovers above the
+    offset level. Both must hold for min_frames frames, which is the detection latency."""
+
+    def __init__(self, fps=500, **kwargs):
+        self.fps = fps
+        self.baseline_time = 2.0 # Seconds, time constant of the baseline
+        self.warmup_time = 0.2 # Seconds before detection starts
+        self.onset_drop = 0.25 # Relative drop from the baseline for the onset
+        self.offset_drop = 0.15 # Relative drop from the baseline for the offset
+        self.noise_factor = 4.0 # Onset level is at least this many deviations below the baseline
+        self.min_frames = 3
+        self.max_time = 1.0 # Seconds, longer events are level changes, not blinks
+        if 'baselineTime' in kwargs:
+            self.baseline_time = kwargs['baselineTime']
+        if 'warmupTime' in kwargs:
+            self.warmup_time = kwargs['warmupTime']
+        if 'onsetDrop' in kwargs:
+            self.onset_drop = kwargs['onsetDrop']
+        if 'offsetDrop' in kwargs:
+            self.offset_drop = kwargs['offsetDrop']
+        if 'noiseFactor' in kwargs:
+            self.noise_factor = kwargs['noiseFactor']
+        if 'minFrames' in kwargs:
+            self.min_frames = kwargs['minFrames']
+        if 'maxTime' in kwargs:
+            self.max_time = kwargs['maxTime']
+        self.baseline_frames = max(int(self.baseline_time * fps), 1)
+        self.warmup_frames = int(self.warmup_time * fps)
+        self.max_frames = max(int(self.max_time * fps), self.min_frames)
+        self.blink_count = 0
+        self.reset()
+
+    def reset(self):
+        """Forgets the baseline and any blink in progress, e.g. after seeking."""
+        self.samples = 0
+        self.baseline = 0.0
+        self.deviation = 0.0
+        self.closed = False # Eye closed, blink confirmed
+        self.start = None # (frame number, time) where the pending onset or offset started
+        self.pending = 0 # Frames the pending onset or offset has lasted
+        self.blink_start = None
+        self.blink_frames = 0
+        self.blink_min = 0
+
+    def state(self):
+        """Returns the state of the detection as a dict, e.g. for a checkpoint. Restored with
+        restore."""
+        return {'samples': self.samples, 'baseline': self.baseline, 'deviation': self.deviation,
+                'closed': self.closed, 'start': self.start, 'pending': self.pending,
+                'blink_start': self.blink_start, 'blink_frames': self.blink_frames,
+                'blink_min': self.blink_min, 'blink_count': self.blink_count}
+
+    def restore(self, state):
+        """Continues the detection from the state returned by state."""
+        for name, value in state.items():
+            # Frame number and time pairs are lists in JSON
+            if name in ('start', 'blink_start') and value is not None:
+                value = tuple(value)
+            setattr(self, name, value)
+
+    def onset_level(self):
+        return self.baseline - max(self.onset_drop * self.baseline,
+                                   self.noise_factor * self.deviation)
+
+    def offset_level(self):
+        return self.baseline * (1 - self.offset_drop)
+
+    def update(self, frame_num, frame_time, count):
+        """Adds count of the frame. Returns event row (event, frame number, time in ms, count,
+        baseline, latency in frames, latency in ms, duration in ms) when blink onset or offset is
+        confirmed, otherwise None. Event is 'cancel' if the eye stayed closed too long."""
+        if self.closed:
+            return self.update_closed(frame_num, frame_time, count)
+
+        if self.samples >= self.warmup_frames and count < self.onset_level():
+            if self.start is None:
+                self.start = (frame_num, frame_time)
+                self.pending = 0
+                self.blink_min = count
+            self.pending += 1
+            self.blink_min = min(self.blink_min, count)
+            if self.pending >= self.min_frames:
+                self.closed = True
+                self.blink_start = self.start
+                self.blink_frames = self.pending
+                self.start = None
+                self.blink_count += 1
+                return self.event('onset', frame_num, frame_time, self.blink_start, 0.0)
+            return None
+
+        # Baseline is updated only while the eye is open. Running mean until the baseline window
+        # is full, exponential average after that.
+        self.start = None
+        self.samples += 1
+        alpha = 1.0 / min(self.samples, self.baseline_frames)
+        error = count - self.baseline
+        self.baseline += alpha * error
+        self.deviation += alpha * (abs(error) - self.deviation)
+        return None
+
+    def update_closed(self, frame_num, frame_time, count):
+        """Follows the blink in progress until the offset is confirmed."""
+        self.blink_frames += 1
+        self.blink_min = min(self.blink_min, count)
+        if self.blink_frames > self.max_frames:
+            # Count didn't recover, so baseline is learned again from the new level
+            event = self.event('cancel', frame_num, frame_time, self.blink_start, 0.0)
+            self.reset()
+            return event
+
+        if count > self.offset_level():
+            if self.start is None:
+                self.start = (frame_num, frame_time)
+                self.pending = 0
+            self.pending += 1
+            if self.pending >= self.min_frames:
+                duration = self.start[1] - self.blink_start[1]
+                event = self.event('offset', frame_num, frame_time, self.start, duration)
+                self.closed = False
+                self.start = None
+                return event
+        else:
+            self.start = None
+        return None
+
+    def event(self, name, frame_num, frame_time, start, duration):
+        """Event row of the onset or offset that started at start and was confirmed at the
+        frame."""
+        return (name, start[0], start[1], int(self.blink_min), round(self.baseline, 1),
+                frame_num - start[0], round(frame_time - start[1], 3), round(duration, 3))
+
+
+class BlinkEventTap:
+    """Passes analysis result rows to the result writer and to the blink detector. Blink events are
+    written to CSV file as soon as they are detected."""
+
+    def __init__(self, data_out, events_file, detector):
+        self.data_out = data_out
+        self.detector = detector
+        # Every event is written and flushed immediately
+        self.events = CsvResultWriter(events_file, batch_size=1, flush_interval=0)
+
+    def append(self, row):
+        """Adds row (frame number, time in ms, data) to the output and to the detector."""
+        self.data_out.append(row)
+        event = self.detector.update(*row)
+        if event is not None:
+            self.events.append(event)
+
+    def extend(self, rows):
+        """Adds many rows to the output."""
+        for row in rows:
+            self.append(row)
+
+    def flush(self):
+        self.data_out.flush()
+        self.events.flush()
+
+    def sync(self):
+        """Writes results and events to the disk. Returns positions and detector state for
+        resume."""
+        return [self.data_out.sync(), self.events.sync(), self.detector.state()]
+
+    def resume(self, position, row_count):
+        """Continues results, events and the detection from the positions and state returned by
+        sync."""
+        self.data_out.resume(position[0], row_count)
+        # Events file doesn't exist, if there were no events before the checkpoint
+        if position[1]:
+            self.events.resume(position[1], 0)
+        self.detector.restore(position[2])
+
+    def close(self):
+        self.data_out.close()
+        self.events.close()
+
+    def __len__(self):
+        return len(self.data_out)
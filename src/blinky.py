@@ -2,7 +2,9 @@
 the GUI"""
 import sys
 import argparse
+import glob
 import blinky_app
+from profiling import profiler
 from pathlib import Path
 
 input_file = None
@@ -10,23 +12,149 @@ parameters_file = None
 output_file = None
 cascade_file = Path('./haar_cascades/haarcascade_eye.xml')
 gui = False
+jobs = 1
+prefetch = 0
+output_format = 'csv'
+checkpoint_interval = 0
+use_cache = False
+sweep = False
+blinks = False
+live_source = None
+replay = False
+max_queue = 2
+use_index = False
+profile = None
+batch_files = None
+video_suffixes = ('.avi', '.mp4', '.mkv', '.mpeg', '.raw')
 
 def run_parser():
     """Setup parser."""
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', help='define input file')
     parser.add_argument('-p', '--parameters', help='define parameters file')
-    parser.add_argument('-o', '--output', help='define output csv-file')
+    parser.add_argument('-o', '--output', help='define output csv-file (or directory for npy)')
+    parser.add_argument('-f', '--format', choices=('csv', 'npy'), default='csv',
+                        help='define output format: csv-file or directory of NumPy columns')
     parser.add_argument('-c', '--cascade', help='define haar cascade file for detecting eye')
+    parser.add_argument('-b', '--batch', nargs='+',
+                        help='define directories or glob patterns of input files for batch analysis')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='analyze video (or batch of videos) in parallel with given number of '
+                             'processes')
+    parser.add_argument('--checkpoint', type=int, default=0,
+                        help='save checkpoint every given number of frames and continue from it if '
+                             'interrupted')
+    parser.add_argument('--cache', action='store_true',
+                        help='cache eye area and blurred frames for fast re-analysis with new '
+                             'parameters')
+    parser.add_argument('--index', action='store_true',
+                        help='build frame index next to the video (once) for exact and fast seeking')
+    parser.add_argument('--sweep', action='store_true',
+                        help='count white pixels for all the thresholds in one pass and suggest '
+                             'threshold')
+    parser.add_argument('--blinks', action='store_true',
+                        help='detect blinks while analyzing and save onset and offset events to '
+                             'csv-file next to the output')
+    parser.add_argument('--live', metavar='SOURCE',
+                        help='analyze live from camera device id, or replay video file at its frame '
+                             'rate as a stand-in for the camera')
+    parser.add_argument('--max-queue', type=int, default=2,
+                        help='frames waiting for the live analysis before the oldest are dropped')
+    parser.add_argument('--profile', nargs='?', const='', metavar='TRACE_FILE',
+                        help='time decoding, tracking, filtering and GUI stages and print summary. '
+                             'Optionally write the trace to json file')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='decode frames ahead in a background thread with given buffer size')
     parser.set_defaults(func=process_args)
 
     args = parser.parse_args()
     args.func(args)
 
+def find_videos(paths):
+    """Finds video files from the given directories and glob patterns."""
+    files = []
+    for path in paths:
+        if Path(path).is_dir():
+            matches = [str(file) for file in Path(path).iterdir()
+                       if file.suffix.lower() in video_suffixes]
+        else:
+            matches = [match for match in glob.glob(path)
+                       if Path(match).suffix.lower() in video_suffixes]
+        for match in sorted(matches):
+            file = Path(match)
+            if file.is_file() and file not in files:
+                files.append(file)
+    return files
+
 def process_args(args):
     """Parse user inputs. Generates parameters and output file names if not given."""
-    global input_file, parameters_file, output_file, cascade_file, gui
-    if args.input:
+    global input_file, parameters_file, output_file, cascade_file, gui, jobs, batch_files, prefetch
+    global output_format, checkpoint_interval, use_cache, sweep, profile, blinks
+    global live_source, replay, max_queue, use_index
+    if args.cascade:
+        cascade_file = Path(args.cascade)
+
+    jobs = max(args.jobs, 1)
+    prefetch = max(args.prefetch, 0)
+    output_format = args.format
+    checkpoint_interval = max(args.checkpoint, 0)
+    use_cache = args.cache
+    sweep = args.sweep
+    blinks = args.blinks
+    use_index = args.index
+    max_queue = max(args.max_queue, 1)
+    profile = args.profile
+
+    if args.batch:
+        # Batch is analyzed from start to end with the parameters file of each video
+        if sweep or checkpoint_interval:
+            sys.exit("Threshold sweep and checkpoints are not supported in batch mode!")
+
+        batch_files = find_videos(args.batch)
+
+        if not batch_files:
+            sys.exit("No video files found!")
+
+        if not cascade_file.exists():
+            sys.exit("Haar Cascade file missing!")
+
+        print("\nBatch of {} files".format(len(batch_files)))
+        print("Cascade file '{}'".format(cascade_file))
+        print("Output format {}".format(output_format))
+        print("Processes {}".format(jobs))
+
+    elif args.live:
+        if args.live.isdigit():
+            live_source = int(args.live)
+            name = Path("camera{}".format(live_source))
+        else:
+            live_source = args.live
+            replay = True
+            name = Path(live_source)
+            if not name.exists():
+                sys.exit("Video file not found!")
+
+        if args.parameters:
+            parameters_file = Path(args.parameters)
+        else:
+            parameters_file = name.parent / (name.stem + "_analysis.prm")
+
+        if args.output:
+            output_file = Path(args.output)
+        elif output_format == 'npy':
+            output_file = name.parent / (name.stem + "_live")
+        else:
+            output_file = name.parent / (name.stem + "_live.csv")
+
+        if not cascade_file.exists():
+            sys.exit("Haar Cascade file missing!")
+
+        print("\nLive source '{}'{}".format(live_source, " (replay)" if replay else ""))
+        print("Parameters file '{}'".format(parameters_file))
+        print("Output file '{}' ({})".format(output_file, output_format))
+        print("Cascade file '{}'".format(cascade_file))
+
+    elif args.input:
         input_file = Path(args.input)
         if args.parameters:
             parameters_file = Path(args.parameters)
@@ -35,12 +163,11 @@ def process_args(args):
 
         if args.output:
             output_file = Path(args.output)
+        elif output_format == 'npy':
+            output_file = input_file.parent / (input_file.stem + "_analysis")
         else:
             output_file = input_file.parent / (input_file.stem + "_analysis.csv")
 
-        if args.cascade:
-            cascade_file = Path(args.cascade)
-
         if not input_file.exists():
             sys.exit("Video file not found!")
 
@@ -49,8 +176,9 @@ def process_args(args):
 
         print("\nInput file '{}'".format(input_file))
         print("Parameters file '{}'".format(parameters_file))
-        print("Output file '{}'".format(output_file))
+        print("Output file '{}' ({})".format(output_file, output_format))
         print("Cascade file '{}'".format(cascade_file))
+        print("Processes {}".format(jobs))
 
     else:
         # Run GUI if no arguments given
@@ -60,7 +188,23 @@ def process_args(args):
 
 def main():
     run_parser()
-    blinky_app.run(input_file, parameters_file, output_file, cascade_file, gui)
+    if profile is not None:
+        # Only stages run in this process are timed
+        profiler.enable()
+    if live_source is not None:
+        blinky_app.run_live(live_source, parameters_file, output_file, cascade_file, output_format,
+                            replay, max_queue, blinks)
+    elif batch_files:
+        blinky_app.run_batch(batch_files, cascade_file, jobs, blinks, use_index, output_format,
+                             use_cache, prefetch)
+    else:
+        blinky_app.run(input_file, parameters_file, output_file, cascade_file, gui, jobs, prefetch,
+                       output_format, checkpoint_interval, use_cache, sweep, blinks, use_index)
+    if profile is not None:
+        profiler.print_summary()
+        if profile:
+            profiler.save(profile)
+            print("Profiling trace saved to '{}'".format(profile))
 
 
 if __name__ == "__main__":
@@ -1,20 +1,49 @@
 """
 Quick and dirty GUI and command line user interface for blink detection application. Rework needed
-for implementing better strcture (MVC?) and for performance via threading/multiprocessing.
+for implementing better strcture (MVC?).
 """
 import sys, os
 import copy
-import csv
 import cv2 as cv
 import numpy as np
+import multiprocessing
+import queue
+import threading
+import time
 
 from pathlib import Path
 
-from capture import Capture
+from capture import Capture, PrefetchCapture, LiveCapture
 from user_interface import VideoWindow
-from filtering import VideoFiltering
+from filtering import VideoFiltering, LuminanceFiltering
 from tracking import Tracking
-from utils import Parameters
+from frame import Frame
+from utils import Parameters, RateLimiter
+from results import CsvResultWriter, NpyResultWriter, NpyAppender
+from checkpoint import Checkpoint
+from cache import StageCache
+from sweep import save_sweep, suggest_threshold
+from profiling import profiled, Profiler
+from blinks import BlinkDetector, BlinkEventTap
+from frame_index import FrameIndex
+from framestore import RawCapture
+
+# Default parameters, used when there is no parameters file
+DEFAULT_PARAMETERS = {
+    'b_val': 118,
+    'c_val': 61,
+    'thres_val': 85,
+    'blur_val': 3,
+    'pad_val': 12,
+    'area_x': 160,
+    'area_y': 160,
+    'const_track': 0}
+
+# Maximum frame count of the chunk in the parallel analysis. Keeps results of the chunks small.
+CHUNK_FRAMES = 10000
+
+# Maximum rate of the GUI updates (per second) while previewing or analyzing
+DISPLAY_RATE = 30
 
 def init_gui():
     """Initialize GUI window"""
@@ -43,63 +72,525 @@ def update_parameters(window, params):
         params.params['pad_val'] = window.pad.get()
         params.params['const_track'] = window.const_track.get()
 
+@profiled
+def update_gui_frames(window, disp_filt, out_filt):
+    """Shows display and output frames in the GUI and updates the GUI."""
+    window.add_video_frame_left(disp_filt.frame.frame, disp_filt.frame.get_frame_size())
+    window.add_video_frame_right(out_filt.frame.frame, out_filt.frame.get_frame_size())
+    window.update_gui()
+
 def update_counter(counter, frame, cap):
     """Updates frame counter in the GUI."""
     counter.config(text = "Frame {} / {}".format(int(frame.frame.frame_num), int(cap.total_frames)))
 
-def update_counter_cmd(frame, cap):
+def update_counter_cmd(frame, total_frames):
     """Updates frame counter (progress) in the command line. May be faster without."""
-    print("Analyzing frame {} / {}".format(int(frame.frame.frame_num), int(cap.total_frames)), end='\r')
+    print("Analyzing frame {} / {}".format(int(frame.frame.frame_num), int(total_frames)), end='\r')
 
 def append_frame_data(data, frame):
     """Appends frame number, time in ms and data (sum of white pixels) to output variable."""
     # frame number, time in ms, data
     data.append((frame.frame.frame_num, frame.frame.frame_time, frame.frequencies()))
 
-def init_capture(input_file):
+def publish_latest(display, item):
+    """Puts item to the display queue of size one. Item not yet shown is replaced."""
+    while True:
+        try:
+            display.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                display.get_nowait()
+            except queue.Empty:
+                pass
+
+def analyze_worker(input_file, params, cascade_file, haar_pt, data_out, display, stop, prefetch=0):
+    """Analyzes the video for the GUI in a worker thread, so the analysis isn't limited by the GUI
+    updates. Frames are captured and tracked as in the command line analysis. Copies of the latest
+    frames and the eye area are published to the display queue at the display rate, and None when
+    the analysis has ended. Set stop event to end early."""
+    out_filt = LuminanceFiltering()
+    limiter = RateLimiter(DISPLAY_RATE)
+    frames = iter_frames(input_file, params, cascade_file, haar_pt, 24, None, prefetch)
+    try:
+        for frame, haar_pt in frames:
+            if stop.is_set():
+                break
+            out_filt.frame = Frame(frame.frame, frame.frame_num, frame.frame_time)
+            out_filt.process(params, haar_pt)
+            append_frame_data(data_out, out_filt)
+
+            # Only the shown frames are copied
+            if limiter.ready():
+                publish_latest(display, (
+                    Frame(frame.frame.copy(), frame.frame_num, frame.frame_time),
+                    Frame(out_filt.frame.frame.copy(), out_filt.frame.frame_num,
+                          out_filt.frame.frame_time),
+                    haar_pt))
+    finally:
+        # Releases the capture, if stopped early
+        frames.close()
+        publish_latest(display, None)
+
+def start_analysis(input_file, params, cascade_file, haar_pt, data_out, prefetch=0):
+    """Starts the GUI analysis in a worker thread. Returns the thread, display queue and stop
+    event."""
+    display = queue.Queue(maxsize=1)
+    stop = threading.Event()
+    worker = threading.Thread(target=analyze_worker, args=(input_file, params, cascade_file,
+                                                           haar_pt, data_out, display, stop,
+                                                           prefetch), daemon=True)
+    worker.start()
+    return worker, display, stop
+
+def show_analysis(window, counter, display, disp_filt, out_filt, pad, cap):
+    """Shows the latest frames published by the analysis worker. Waits for the frames at most the
+    display interval, so the GUI stays responsive. Returns False when the analysis has ended."""
+    try:
+        frames = display.get(timeout=1 / DISPLAY_RATE)
+    except queue.Empty:
+        window.update_gui()
+        return True
+    if frames is None:
+        return False
+    disp_filt.frame, out_filt.frame, haar_pt = frames
+    if haar_pt:
+        disp_filt.draw_bounding_box(haar_pt, pad)
+    update_counter(counter, out_filt, cap)
+    update_gui_frames(window, disp_filt, out_filt)
+    return True
+
+def print_tracking_stats():
+    """Prints time spent loading and running the haar cascade."""
+    stats = Tracking.get_stats()
+    print("\nCascade loaded {} times in {:.3f} s".format(stats['load_count'], stats['load_time']))
+    print("Eye detection run {} times in {:.3f} s".format(stats['detect_count'],
+                                                       stats['detect_time']))
+
+def load_parameters(parameters_file):
+    """Loads parameters from file, if exists. Otherwise uses and saves the defaults."""
+    # Init Parameters object where all the parameters are saved
+    params = Parameters(parameters_file, dict())
+    if parameters_file.exists():
+        print("Loading parameters from file.")
+        params.load_parameters()
+    else:
+        # No parameter file, so using defaults
+        print("No parameters file. Loading default parameters." )
+        params.params.update(DEFAULT_PARAMETERS)
+        params.save_parameters()
+    return params
+
+def open_capture(input_file, prefetch=0, **kwargs):
+    """Opens capture for the input file. With prefetch frames are decoded ahead in a background
+    thread to a ring of given size. Frame index of the video is used for seeking, if it exists.
+    Raw frame stores are read directly without decoding."""
+    if Path(input_file).suffix == '.raw':
+        return RawCapture(str(input_file), **kwargs)
+    if 'index' not in kwargs:
+        kwargs['index'] = FrameIndex.open(input_file, build=False)
+    if prefetch:
+        return PrefetchCapture(str(input_file), prefetch, **kwargs)
+    return Capture(str(input_file), **kwargs)
+
+def init_output(output_file, output_format='csv', params=None):
+    """Initializes result writer. 'npy' writes columns to a directory of NumPy files with the
+    parameters, otherwise CSV file is written."""
+    if output_format == 'npy':
+        return NpyResultWriter(output_file, params)
+    return CsvResultWriter(output_file)
+
+def sidecar_filename(output_file, name):
+    """Filename for the additional output (blink events, latencies) next to the output."""
+    output_file = Path(output_file)
+    return output_file.parent / (output_file.stem + "_" + name + ".csv")
+
+def init_capture(input_file, prefetch=0):
     """Initializes capture object from the input file."""
-    cap = Capture(str(input_file))
+    cap = open_capture(input_file, prefetch)
     cap.capture_frame()
     return cap
 
-def run(input_file, parameters_file, output_file, cascade_file, gui):
-    data_out = [] # Output variable
-    save = True # Toggle save function
-    rec_reset = True # Toggle reset for analyzing in the cmd
-
+def iter_frames(input_file, params, cascade_file, haar_pt, start_frame, end_frame, prefetch=0):
+    """Captures frames from start_frame to end_frame (None for the end of the video) and tracks the
+    eye starting from the eye area haar_pt. Yields captured frames with their eye areas. Frame is
+    valid until the next frame is yielded. Capture is released when the generator is closed."""
+    cap = open_capture(input_file, prefetch, start_frame=start_frame)
+    tracker = Tracking()
+    if haar_pt:
+        tracker.set_tracking_point('haar', haar_pt)
+
+    try:
+        while cap.capture_open():
+            if cap.capture_frame() is None:
+                break
+            if end_frame is not None and cap.frame.frame_num > end_frame:
+                cap.release_capture()
+                break
+            tracker.frame = cap.frame
+
+            if not haar_pt:
+                tracker.haar_classifier(cascadeFile=str(cascade_file))
+                haar_pt = tracker.get_tracking_point('haar')
+
+            yield cap.frame, haar_pt
+
+            if params['const_track']:
+                tracker.template_tracking(cascadeFile=str(cascade_file), minSize=(24, 54))
+                haar_pt = tracker.get_tracking_point('haar')
+    finally:
+        if cap.capture_open():
+            cap.release_capture()
+
+def iter_crops(input_file, params, cascade_file, haar_pt, start_frame, end_frame, prefetch=0):
+    """Captures frames from start_frame to end_frame (None for the end of the video) in the command
+    line mode and yields them as luminance planes of the eye area. Plane is valid until the next
+    frame is yielded."""
+    crop_filt = LuminanceFiltering()
+    for frame, haar_pt in iter_frames(input_file, params, cascade_file, haar_pt, start_frame,
+                                      end_frame, prefetch):
+        # Filters only read the captured frame, so no copy is needed
+        crop_filt.frame = Frame(frame.frame, frame.frame_num, frame.frame_time)
+        crop_filt.eye_area(haar_pt, params['pad_val'])
+        yield crop_filt.frame
+
+def analyze_chunk(input_file, params, cascade_file, haar_pt, start_frame, end_frame, prefetch=0,
+                  data_out=None):
+    """Analyzes frames from start_frame to end_frame (None for the end of the video) in the command
+    line mode. Eye area from the first frame is shared, so without tracking the chunks give the
+    same result as analyzing the whole video at once. Tracking state is not shared, and it can't be
+    rebuilt by tracking frames before the chunk, so tracked chunks differ. Frame data is appended
+    to data_out, list by default."""
+    if data_out is None:
+        data_out = []
+    out_filt = LuminanceFiltering()
+    for crop in iter_crops(input_file, params, cascade_file, haar_pt, start_frame, end_frame,
+                           prefetch):
+        out_filt.frame = Frame(crop.frame, crop.frame_num, crop.frame_time)
+        out_filt.binarize(params)
+        append_frame_data(data_out, out_filt)
+    return data_out
+
+def analyze_serial(input_file, params, cascade_file, haar_pt, total_frames, data_out, prefetch=0,
+                   checkpoint=None, resume=None):
+    """Analyzes the video in one process in the command line mode, saving checkpoints if given.
+    With resume state of a checkpoint, output and tracking are continued from it. Frames are
+    captured and tracked as in analyze_chunk, so the results are the same."""
+    start_frame = 24
+    if resume:
+        print("Continuing from the checkpoint at frame {}.".format(resume['frame_num']))
+        data_out.resume(resume['output_position'], resume['row_count'])
+        haar_pt = resume['tracking_points'].get('haar')
+        start_frame = resume['frame_num']
+
+    out_filt = LuminanceFiltering()
+    due = None
+    for frame, haar_pt in iter_frames(input_file, params, cascade_file, haar_pt, start_frame, None,
+                                      prefetch):
+        # Checkpoint is saved with the eye area tracked for the next frame, where it continues
+        if due is not None:
+            checkpoint.save(due, {'haar': haar_pt} if haar_pt else {}, data_out.sync(),
+                            len(data_out))
+            due = None
+        out_filt.frame = Frame(frame.frame, frame.frame_num, frame.frame_time)
+        out_filt.process(params, haar_pt)
+        update_counter_cmd(out_filt, total_frames)
+        append_frame_data(data_out, out_filt)
+        if checkpoint is not None and checkpoint.is_due(frame.frame_num):
+            due = frame.frame_num
+
+def analyze_cached(input_file, params, cascade_file, haar_pt, cache, data_out, prefetch=0):
+    """Analyzes video in the command line mode using the stage cache. Eye area crops and blurred
+    crops are loaded from the cache if made with the same parameters, so only the stages after them
+    are run. Missing stages are cached."""
+    crop_params = {'pad_val': params['pad_val'], 'const_track': params['const_track'],
+                   'cascade_file': str(Path(cascade_file).resolve())}
+    blur_params = dict(crop_params, blur_val=params['blur_val'])
+    crop_writer = None
+    blur_writer = None
+
+    frames = cache.load('blur', blur_params)
+    if frames is not None:
+        print("Using cached blurred eye area of {} frames.".format(len(frames)))
+    else:
+        frames = cache.load('crop', crop_params)
+        if frames is not None:
+            print("Using cached eye area of {} frames.".format(len(frames)))
+        else:
+            print("No cached stages. Decoding the video.")
+            frames = iter_crops(input_file, params, cascade_file, haar_pt, 24, None, prefetch)
+            crop_writer = cache.writer('crop', crop_params)
+        blur_writer = cache.writer('blur', blur_params)
+
+    out_filt = LuminanceFiltering()
+    for frame in frames:
+        if crop_writer is not None:
+            crop_writer.append(frame)
+        out_filt.frame = Frame(frame.frame, frame.frame_num, frame.frame_time)
+        # Blurred stage is cached, so blurring is done here instead of binarize
+        if blur_writer is not None:
+            out_filt.blur((params['blur_val'], params['blur_val']))
+            blur_writer.append(out_filt.frame)
+        out_filt.binarize(params, blur=False)
+        append_frame_data(data_out, out_filt)
+
+    for writer in (crop_writer, blur_writer):
+        if writer is not None:
+            writer.close()
+
+def sweep_thresholds(input_file, params, cascade_file, haar_pt, output_dir, prefetch=0):
+    """Analyzes video once for all the thresholds. Histograms of the thresholds at which the
+    pixels of the filtered and resized eye area turn white are saved per frame, and white pixel
+    counts of every threshold are computed from them. Counts are the same as in the analysis,
+    except for the threshold 0. Returns suggested threshold."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    histograms = NpyAppender(output_dir / 'histograms.npy', np.uint32, (256,))
+    frame_nums = NpyAppender(output_dir / 'frame_num.npy', np.int64)
+    frame_times = NpyAppender(output_dir / 'frame_time.npy', np.float64)
+
+    out_filt = LuminanceFiltering()
+    for crop in iter_crops(input_file, params, cascade_file, haar_pt, 24, None, prefetch):
+        out_filt.frame = Frame(crop.frame, crop.frame_num, crop.frame_time)
+        out_filt.blur((params['blur_val'], params['blur_val']))
+        # Threshold 0 leaves the frame unthresholded
+        out_filt.lut_threshold(params['b_val'], params['c_val'], 0)
+        out_filt.white_thresholds((params['area_x'], params['area_y']))
+        histograms.append(out_filt.histogram())
+        frame_nums.append(crop.frame_num)
+        frame_times.append(crop.frame_time)
+
+    for appender in (histograms, frame_nums, frame_times):
+        appender.close()
+
+    histograms = np.load(output_dir / 'histograms.npy', mmap_mode='r')
+    save_sweep(output_dir, histograms)
+    return suggest_threshold(histograms)
+
+def run_live(source, parameters_file, output_file, cascade_file, output_format='csv', replay=False,
+             max_queue=2, blinks=False):
+    """Analyzes live source (camera device id) until it ends or Ctrl+C is pressed. Video file is
+    replayed at its frame rate as a stand-in for the camera. Frames are dropped if the analysis
+    falls behind, and latency from the capture to the result is saved for every frame."""
+    params = load_parameters(parameters_file)
+    data_out = init_output(output_file, output_format, params.params)
+    latency_out = CsvResultWriter(sidecar_filename(output_file, 'latency'))
+    latency = Profiler()
+    latency.enable()
+
+    cap = LiveCapture(source, max_queue, replay)
+    fps = cap.get_fps()
+    print("\nFPS of the source: {}".format(int(fps)))
+    detector = None
+    if blinks:
+        # Cameras may not report frame rate
+        detector = BlinkDetector(fps) if fps > 0 else BlinkDetector()
+        data_out = BlinkEventTap(data_out, sidecar_filename(output_file, 'blinks'), detector)
+
+    out_filt = LuminanceFiltering()
+    tracker = Tracking()
+    haar_pt = None
+    frame_count = 0
+    print("Analyzing. Press Ctrl+C to stop.")
+    try:
+        while cap.capture_open():
+            if cap.capture_frame() is None:
+                break
+            tracker.frame = cap.frame
+            # Frames are not analyzed before the eye is found
+            if not haar_pt:
+                tracker.haar_classifier(cascadeFile=str(cascade_file))
+                haar_pt = tracker.get_tracking_point('haar')
+                if not haar_pt:
+                    continue
+
+            out_filt.frame = Frame(cap.frame.frame, cap.frame.frame_num, cap.frame.frame_time)
+            out_filt.process(params.params, haar_pt)
+            append_frame_data(data_out, out_filt)
+
+            frame_latency = time.perf_counter() - cap.capture_time
+            latency.record('Capture to result', frame_latency)
+            latency_out.append((out_filt.frame.frame_num, round(frame_latency * 1000, 3),
+                                cap.dropped))
+            frame_count += 1
+            if frame_count % 100 == 0:
+                print("Frame {} latency {:.1f} ms, dropped {} frames".format(
+                    int(out_filt.frame.frame_num), frame_latency * 1000, cap.dropped), end='\r')
+
+            # Next frame is grabbed to another buffer, so tracking can read the current one
+            if params.params['const_track']:
+                tracker.template_tracking(cascadeFile=str(cascade_file), minSize=(24, 54))
+                haar_pt = tracker.get_tracking_point('haar')
+    except KeyboardInterrupt:
+        print("\nStopped by the user.")
+        cap.release_capture()
+
+    data_out.close()
+    latency_out.close()
+    print("\nAnalyzed {} of {} grabbed frames, dropped {}.".format(frame_count, cap.grab_count,
+                                                                  cap.dropped))
+    if frame_count:
+        latency.print_summary()
+        print("Latencies saved to '{}'".format(sidecar_filename(output_file, 'latency')))
+    if detector is not None:
+        print("Detected {} blinks. Events saved to '{}'".format(
+            detector.blink_count, sidecar_filename(output_file, 'blinks')))
+
+def _analyze_chunk(args):
+    """Unpacks arguments for analyze_chunk in the worker process."""
+    return analyze_chunk(*args)
+
+def _init_worker(cascade_file):
+    """Loads cascade once for each worker process."""
+    Tracking.get_cascade(cascade_file)
+
+def analyze_chunks(input_file, params, cascade_file, haar_pt, jobs, total_frames, data_out,
+                   prefetch=0):
+    """Splits video to frame ranges and analyzes them in parallel. Frame data is appended to
+    data_out in order. Only for the analysis without tracking, see analyze_chunk."""
+    # Analysis starts from the frame 24, see Capture.reset
+    start = 24
+    chunk_count = max(jobs, int(np.ceil((total_frames - start) / CHUNK_FRAMES)))
+    chunk_size = int(np.ceil((total_frames - start) / chunk_count))
+    chunks = []
+    for i in range(chunk_count):
+        end = start + chunk_size
+        # Last chunk is read until the video ends. Frame count may not be exact.
+        chunks.append((input_file, params, cascade_file, haar_pt, start,
+                       end if i < chunk_count - 1 else None, prefetch))
+        start = end
+
+    with multiprocessing.Pool(jobs, _init_worker, (str(cascade_file),)) as pool:
+        for i, chunk_data in enumerate(pool.imap(_analyze_chunk, chunks)):
+            print("Analyzed chunk {} / {}".format(i + 1, chunk_count))
+            data_out.extend(chunk_data)
+
+def batch_output_file(input_file, output_format='csv'):
+    """Output file of the video in the batch, named after the video."""
+    if output_format == 'npy':
+        return input_file.parent / (input_file.stem + "_analysis")
+    return input_file.parent / (input_file.stem + "_analysis.csv")
+
+def analyze_file(input_file, cascade_file, blinks=False, output_format='csv', use_cache=False,
+                 prefetch=0):
+    """Analyzes one video of the batch in the command line mode. Parameters file and output file
+    are named after the video. With blinks, blink events are detected while analyzing, and with
+    use_cache the stage cache of the video is used. Returns frame count and analysis time."""
+    start = time.perf_counter()
+    parameters_file = input_file.parent / (input_file.stem + "_analysis.prm")
+    output_file = batch_output_file(input_file, output_format)
+    params = load_parameters(parameters_file)
+
+    # Eye area from the first frame as in the run
+    cap = init_capture(input_file)
+    tracker = Tracking(cap.frame)
+    tracker.haar_classifier(cascadeFile=str(cascade_file))
+    haar_pt = tracker.get_tracking_point('haar')
+    fps = cap.get_fps()
+    cap.release_capture()
+
+    data_out = init_output(output_file, output_format, params.params)
+    if blinks:
+        data_out = BlinkEventTap(data_out, sidecar_filename(output_file, 'blinks'),
+                                 BlinkDetector(fps))
+    if use_cache:
+        cache = StageCache(input_file.parent / (input_file.stem + "_cache"), input_file)
+        analyze_cached(input_file, params.params, cascade_file, haar_pt, cache, data_out, prefetch)
+    else:
+        analyze_chunk(input_file, params.params, cascade_file, haar_pt, 24, None, prefetch,
+                      data_out)
+    data_out.close()
+    return len(data_out), time.perf_counter() - start
+
+def _analyze_file(args):
+    """Unpacks arguments for analyze_file in the worker process."""
+    return args[0], analyze_file(*args)
+
+def is_up_to_date(input_file, output_format='csv'):
+    """Checks if the analysis output is newer than the video and its parameters file."""
+    parameters_file = input_file.parent / (input_file.stem + "_analysis.prm")
+    output_file = batch_output_file(input_file, output_format)
+    if not output_file.exists():
+        return False
+    output_time = output_file.stat().st_mtime
+    if parameters_file.exists() and parameters_file.stat().st_mtime > output_time:
+        return False
+    return input_file.stat().st_mtime <= output_time
+
+def run_batch(input_files, cascade_file, jobs=1, blinks=False, use_index=False,
+              output_format='csv', use_cache=False, prefetch=0):
+    """Analyzes many videos in the command line mode with a pool of worker processes. Videos with
+    up to date analysis are skipped. With use_index missing frame indices are built."""
+    files = []
+    for input_file in input_files:
+        if is_up_to_date(input_file, output_format):
+            print("Skipping '{}', analysis is up to date.".format(input_file))
+        else:
+            files.append(input_file)
+            # Raw frame stores are seeked without an index
+            if use_index and input_file.suffix != '.raw':
+                FrameIndex.open(input_file)
+    print("\nAnalyzing {} videos with {} processes.".format(len(files), jobs))
+
+    start = time.perf_counter()
+    total_frames = 0
+    args = [(input_file, cascade_file, blinks, output_format, use_cache, prefetch)
+            for input_file in files]
+    # Each worker loads the cascade once and reuses it for all of its videos
+    with multiprocessing.Pool(jobs, _init_worker, (str(cascade_file),)) as pool:
+        for i, (input_file, (frames, duration)) in enumerate(pool.imap_unordered(_analyze_file,
+                                                                                 args)):
+            total_frames += frames
+            print("[{} / {}] '{}' {} frames in {:.1f} s ({:.0f} fps)".format(
+                i + 1, len(files), input_file, frames, duration, frames / max(duration, 1e-9)))
+
+    duration = time.perf_counter() - start
+    print("\nAnalyzed {} frames in {:.1f} s ({:.0f} fps)".format(total_frames, duration,
+                                                                 total_frames / max(duration, 1e-9)))
+
+def run(input_file, parameters_file, output_file, cascade_file, gui, jobs=1, prefetch=0,
+        output_format='csv', checkpoint_interval=0, use_cache=False, sweep=False, blinks=False,
+        use_index=False):
     # Setup default settings if GUI in use
     if gui:
-        # Save false, because we don't want to save/overwrite automaticly when in GUI
-        save = False
         window = init_gui()
         input_file = Path(window.ask_file("Input video file"))
         output_file = input_file.parent / (input_file.stem + "_analysis.csv")
         parameters_file = input_file.parent / (input_file.stem + "_analysis.prm")
 
-    # Init Parameters object where all the parameters are saved
-    params = Parameters(parameters_file)
+    params = load_parameters(parameters_file)
 
-    # Loads parameters from file, if exists
-    if parameters_file.exists():
-        print("Loading parameters from file.")
-        params.load_parameters()
-    else:
-        # No parameter file, so using defaults
-        print("No parameters file. Loading default parameters." )
-        # Default parameters
-        params.params['b_val'] = 118
-        params.params['c_val'] = 61
-        params.params['thres_val'] = 85
-        params.params['blur_val'] = 3
-        params.params['pad_val'] = 12
-        params.params['area_x'] = 160
-        params.params['area_y'] = 160
-        params.params['const_track'] = 0
-        params.save_parameters()
+    # Tracked chunks would differ from the analysis of the whole video
+    if not gui and jobs > 1 and params.params['const_track']:
+        print("Tracking can't be split to parallel chunks. Analyzing in one process.")
+        jobs = 1
+
+    # Output is written while analyzing. File is created on the first frame data, so in the GUI it
+    # is not saved/overwritten before the analysis is started.
+    data_out = init_output(output_file, output_format, params.params)
+
+    # Checkpoints for continuing interrupted command line analysis (single process only)
+    checkpoint = None
+    resume = None
+    if not gui and jobs == 1 and not use_cache and not sweep and checkpoint_interval > 0:
+        # Output position of the checkpoint differs with the events file
+        checkpoint = Checkpoint(Path(str(output_file) + '.ckpt'), input_file, output_file,
+                                dict(params.params, blinks=1) if blinks else params.params,
+                                checkpoint_interval)
+        resume = checkpoint.load()
 
+    # Frame index for exact seeking. It's found by the captures from next to the video. Raw frame
+    # stores are seeked without an index.
+    if use_index and input_file.suffix != '.raw':
+        FrameIndex.open(input_file)
 
     # Init capture
-    cap = init_capture(input_file)
+    cap = init_capture(input_file, prefetch)
+
+    # Blink events are detected from the output rows as they are produced
+    detector = None
+    if blinks:
+        detector = BlinkDetector(cap.get_fps())
+        data_out = BlinkEventTap(data_out, sidecar_filename(output_file, 'blinks'), detector)
 
     # If GUI, set controls and add progress frame counter
     if gui:
@@ -107,14 +598,16 @@ def run(input_file, parameters_file, output_file, cascade_file, gui):
         counter = window.create_progress()
 
     # Setup filters
-    pre_filt = VideoFiltering()
-    out_filt = VideoFiltering()
+    # Output is filtered as single luminance plane
+    out_filt = LuminanceFiltering()
     disp_filt = VideoFiltering()
 
     # Setup tracking and identify eye area
     tracker = Tracking(copy.deepcopy(cap.frame))
     tracker.haar_classifier(cascadeFile=str(cascade_file))
     haar_pt = tracker.get_tracking_point('haar')
+    # GUI analysis starts from the eye area of the first frame as in the command line
+    first_pt = haar_pt
     # while not haar_pt:
     #     print("Did not find eye. Trying again next frame.")
     #     cap.capture_frame()
@@ -127,56 +620,107 @@ def run(input_file, parameters_file, output_file, cascade_file, gui):
     print("FPS of the video: {}".format(int(cap.get_fps())))
     print("Runtime in seconds: {}".format(cap.get_lenght_in_s()))
 
+    # Command line analysis in separate processes. Capture is released so the main loop is skipped.
+    if not gui and jobs > 1:
+        analyze_chunks(input_file, dict(params.params), cascade_file, haar_pt, jobs,
+                       cap.get_total_frames(), data_out, prefetch)
+        cap.release_capture()
+    # Counts for all the thresholds at once
+    elif not gui and sweep:
+        output_dir = input_file.parent / (input_file.stem + "_sweep")
+        threshold = sweep_thresholds(input_file, dict(params.params), cascade_file, haar_pt,
+                                     output_dir, prefetch)
+        cap.release_capture()
+        print("\nCounts of all the thresholds saved to '{}'".format(output_dir / 'counts.npy'))
+        print("Suggested threshold: {} (now {})".format(threshold, params.params['thres_val']))
+    # Command line analysis with the stage cache
+    elif not gui and use_cache:
+        cache = StageCache(input_file.parent / (input_file.stem + "_cache"), input_file)
+        analyze_cached(input_file, dict(params.params), cascade_file, haar_pt, cache, data_out,
+                       prefetch)
+        cap.release_capture()
+    # Command line analysis in one process
+    elif not gui:
+        analyze_serial(input_file, dict(params.params), cascade_file, haar_pt,
+                       cap.get_total_frames(), data_out, prefetch, checkpoint, resume)
+        cap.release_capture()
+
+    # GUI analysis runs in a worker thread, previewing in the main loop. Capture is released in the
+    # command line, so the loop is only run for the GUI.
+    worker = None
+    display_limiter = RateLimiter(DISPLAY_RATE)
+
     # Main loop
     # Rework to work with threading and in the tkinter mainloop
     while(cap.capture_open()):
 
+        # While analyzing, GUI only shows the frames published by the worker
+        if worker is not None:
+            if window.get_status() and show_analysis(window, counter, display, disp_filt, out_filt,
+                                                     params.params['pad_val'], cap):
+                continue
+            stop.set()
+            worker.join()
+            worker = None
+            cap.release_capture()
+            continue
+
         if not haar_pt:
             print("Did not find eye. Trying again.")
             tracker.haar_classifier(cascadeFile=str(cascade_file))
             haar_pt = tracker.get_tracking_point('haar')
 
-        # Copy current frame to all filters and trackers
-        pre_filt.frame = copy.deepcopy(cap.frame)
-        out_filt.frame = copy.deepcopy(cap.frame)
-        disp_filt.frame = copy.deepcopy(cap.frame)
-        # Tracking is done for pre filtered frame
-        tracker.frame = copy.deepcopy(pre_filt.frame)
+        # Output filters and tracking only read the current frame, so it is shared with them.
+        # Bounding box is drawn to the display frame, so only that is copied and only for the GUI.
+        out_filt.frame = Frame(cap.frame.frame, cap.frame.frame_num, cap.frame.frame_time)
+        tracker.frame = cap.frame
+        if gui:
+            # GUI is updated at the display rate. Preview advances one frame per update, so frames
+            # are not decoded and filtered faster than they are shown.
+            display_limiter.wait()
+            render = window.get_status()
+            if render:
+                disp_filt.frame = Frame(cap.frame.frame.copy(), cap.frame.frame_num,
+                                        cap.frame.frame_time)
 
 
-        # Draw bounding box for detected area and select region of interest for the ouput frame
-        if haar_pt is not None and haar_pt:
+        # Draw bounding box for detected area
+        if haar_pt is not None and haar_pt and gui and render:
             disp_filt.draw_bounding_box(haar_pt, params.params['pad_val'])
-            out_filt.crop_roi(haar_pt, params.params['pad_val'])
 
-        # Filtering the output
-        out_filt.blur((params.params['blur_val'], params.params['blur_val']))
-        out_filt.brightness_contrast(params.params['b_val'], params.params['c_val'])
-        out_filt.threshold(params.params['thres_val'])
-        out_filt.resize((params.params['area_x'], params.params['area_y']))
+        # Filtering the output from the eye area
+        out_filt.process(params.params, haar_pt)
+
+        # Detect eye location and update if tracking enabled. Done before capturing the next frame,
+        # because prefetching capture reuses the frame buffer.
+        if params.params['const_track']:
+            tracker.template_tracking(cascadeFile=str(cascade_file), minSize=(24, 54))
+            haar_pt = tracker.get_tracking_point('haar')
 
         # These will be run, if in GUI
         if gui:
             # Updating GUI if window is still open
-            if window.get_status():
+            if render:
                 update_counter(counter, out_filt, cap)
                 update_parameters(window, params)
-                window.add_video_frame_left(disp_filt.frame.frame, disp_filt.frame.get_frame_size())
-                window.add_video_frame_right(out_filt.frame.frame, out_filt.frame.get_frame_size())
-                window.update_gui()
-
-            # Check status of preview and analyze buttons in the GUI
-            if window.run or window.prev:
-                # Resets video before running analysis or previw
-                if window.reset or (window.prev and not out_filt.frame.frame_num < cap.get_total_frames() - 1):
+                update_gui_frames(window, disp_filt, out_filt)
+
+            # Analysis of the whole video in the worker thread with the current parameters
+            if window.run and window.get_status():
+                print("Analyzing in the background.")
+                window.run = False
+                window.prev = False
+                worker, display, stop = start_analysis(input_file, dict(params.params), cascade_file,
+                                                       first_pt if first_pt else haar_pt, data_out,
+                                                       prefetch)
+                continue
+
+            # Check status of preview button in the GUI
+            if window.prev:
+                # Resets video before previw
+                if window.reset or not out_filt.frame.frame_num < cap.get_total_frames() - 1:
                     cap.reset()
                     window.reset = False
-                elif window.run:
-                    # Flag save if analysis started
-                    save = True
-                    # Update progress in command line and append frame data to end result
-                    update_counter_cmd(out_filt, cap)
-                    append_frame_data(data_out, out_filt)
                 cap.capture_frame()
 
             # Check parameters save button status and saves
@@ -189,23 +733,12 @@ def run(input_file, parameters_file, output_file, cascade_file, gui):
             if not window.get_status():
                 cap.release_capture()
 
-        # These run only in when in command line
-        else:
-            if rec_reset:
-                cap.reset()
-                rec_reset = False
-            else:
-                update_counter_cmd(out_filt, cap)
-                append_frame_data(data_out, out_filt)
-            cap.capture_frame()
-
-        # Detect eye location and update if tracking enabled
-        if params.params['const_track']:
-            tracker.haar_classifier(cascadeFile=str(cascade_file), minSize=(24, 54))
-            haar_pt = tracker.get_tracking_point('haar')
+    # Write remaining data to csv
+    data_out.close()
+    if checkpoint is not None:
+        checkpoint.remove()
 
-    # Save data to csv if save flag enabled
-    if save:
-        with open(output_file, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerows(data_out)
+    if detector is not None:
+        print("\nDetected {} blinks. Events saved to '{}'".format(
+            detector.blink_count, sidecar_filename(output_file, 'blinks')))
+    print_tracking_stats()
@@ -0,0 +1,113 @@
+"""On-disk cache of the intermediate analysis stages for fast re-analysis with new parameters."""
+import hashlib
+import json
+import os
+import numpy as np
+from pathlib import Path
+from frame import Frame
+from results import NpyAppender
+
+
+class StageCache:
+    """Caches luminance planes of the analysis stages (e.g. eye area crops and blurred crops) to a
+    directory. Stages are keyed by the video and the parameters that produced them, so when only
+    later parameters change, the stage can be loaded instead of decoding the video again."""
+
+    def __init__(self, directory, input_file):
+        self.directory = Path(directory)
+        input_file = Path(input_file)
+        stat = input_file.stat()
+        # Identifies the video of the cached stages
+        self.video = {'input_file': str(input_file.resolve()),
+                      'input_size': stat.st_size,
+                      'input_mtime': stat.st_mtime}
+
+    def key(self, stage, params):
+        """Returns cache key for the stage produced with the parameters."""
+        identity = json.dumps({'video': self.video, 'stage': stage, 'params': params},
+                              sort_keys=True)
+        return '{}_{}'.format(stage, hashlib.sha1(identity.encode()).hexdigest()[:16])
+
+    def files(self, stage, params):
+        """Returns file names of the frames, frame numbers and frame times of the stage."""
+        key = self.key(stage, params)
+        return [self.directory / '{}_{}.npy'.format(key, name)
+                for name in ('frames', 'frame_num', 'frame_time')]
+
+    def load(self, stage, params):
+        """Returns cached stage as memory-mapped arrays or None if it is not cached."""
+        files = self.files(stage, params)
+        if not all(file.exists() for file in files):
+            return None
+        frames, frame_num, frame_time = [np.load(file, mmap_mode='r') for file in files]
+        return CachedStage(frames, frame_num, frame_time)
+
+    def writer(self, stage, params):
+        """Returns writer for caching the stage."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return StageWriter(self.files(stage, params))
+
+
+class CachedStage:
+    """Frames of the cached stage. Iterating gives Frame objects with the luminance planes."""
+
+    def __init__(self, frames, frame_num, frame_time):
+        self.frames = frames
+        self.frame_num = frame_num
+        self.frame_time = frame_time
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        for i in range(len(self.frames)):
+            yield Frame(self.frames[i], int(self.frame_num[i]), float(self.frame_time[i]))
+
+
+class StageWriter:
+    """Writes frames of the stage to temporary files, which are renamed when the stage is complete.
+    Stage is cached only if all the frames have the same size."""
+
+    def __init__(self, files):
+        self.files = files
+        self.temp_files = [file.with_name(file.name + '.part') for file in files]
+        self.appenders = None
+        self.aborted = False
+
+    def append(self, frame):
+        """Adds Frame with luminance plane to the stage."""
+        if self.aborted:
+            return
+        if self.appenders is None:
+            self.appenders = [NpyAppender(self.temp_files[0], frame.frame.dtype, frame.frame.shape),
+                              NpyAppender(self.temp_files[1], np.int64),
+                              NpyAppender(self.temp_files[2], np.float64)]
+        elif frame.frame.shape != self.appenders[0].shape:
+            print("\nEye area size changed, stage is not cached.")
+            self.abort()
+            return
+        self.appenders[0].append(frame.frame)
+        self.appenders[1].append(frame.frame_num)
+        self.appenders[2].append(frame.frame_time)
+
+    def abort(self):
+        """Stops caching and removes the temporary files."""
+        self.aborted = True
+        self._close()
+        for file in self.temp_files:
+            if file.exists():
+                file.unlink()
+
+    def close(self):
+        """Completes the stage."""
+        if self.aborted or self.appenders is None:
+            return
+        self._close()
+        for temp_file, file in zip(self.temp_files, self.files):
+            os.replace(temp_file, file)
+
+    def _close(self):
+        if self.appenders is not None:
+            for appender in self.appenders:
+                appender.close()
+            self.appenders = None
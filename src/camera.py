@@ -3,7 +3,12 @@ from pypylon import genicam
 from pathlib import Path
 import cv2 as cv
 import skvideo.io
-import csv
+import threading
+from recording import RecordingPipeline, MetadataLog, log_filename
+from framestore import FrameStoreWriter
+from utils import RateLimiter
+
+DISPLAY_RATE = 30 # Frames shown per second in the preview and in the video window
 
 """Camera class for controlling and recording high speed video from Basler USB-cameras."""
 class Camera:
@@ -49,14 +54,26 @@ class Camera:
         }
 
         self.parameters['record'] = True
-        file = Path(self.parameters['output_file'])
-        self.parameters['output_csv'] = file.parent / (file.stem + "_recording.csv")
-        self.data_out = []
+        # Mono8 frames are recorded as grayscale without converting them to RGB
+        self.parameters.setdefault('mono', True)
+        if self.parameters['mono']:
+            self.parameters['ffmpeg_param_in'] = {'-pix_fmt': 'gray'}
+            self.parameters['ffmpeg_param_out']['-pix_fmt'] = 'gray'
+        # Timing values of the frames are streamed to the log while recording
+        self.parameters['output_log'] = log_filename(self.parameters['output_file'])
+        self.log = None
 
         self.counter = 0
         self.first_timestamp = 0 # First time stamp is used for calculating start point as 0
-
-        # Setup converter
+        self.ring_size = 1000 # Frames buffered for the encoder while recording
+        self.image = None # Converted image of the last grabbed frame
+        self.display = RateLimiter(DISPLAY_RATE) # Video window is updated at the display rate
+        self.preview_thread = None
+        self.preview_lock = threading.Lock()
+        self.preview_frame = None # Latest preview frame and its number
+        self.preview_count = 0
+
+        # Setup converter, used only if not recording Mono8 as is
         self.converter = pylon.ImageFormatConverter()
         # Convert to RGB8 to support skvideo
         self.converter.OutputPixelFormat = pylon.PixelType_RGB8packed
@@ -152,7 +169,21 @@ class Camera:
         #                 self.parameters['height']))
         # Changed to support skvideo
         # self.output = skvideo.io.FFmpegWriter(self.parameters['output_file'], inputdict=self.parameters['ffmpeg_param_in'], outputdict=self.parameters['ffmpeg_param_out'])
-        self.output = skvideo.io.FFmpegWriter(self.parameters['output_file'], outputdict=self.parameters['ffmpeg_param_out'])
+        if Path(self.parameters['output_file']).suffix == '.raw':
+            # Raw frame store without encoding, transcoded later with framestore.py. Metadata log
+            # of the recording is the index of the store.
+            shape = (self.parameters['height'], self.parameters['width'])
+            if not self.parameters['mono']:
+                shape += (3,)
+            self.output = FrameStoreWriter(self.parameters['output_file'], shape,
+                                           self.parameters['fps'],
+                                           capacity=int(self.parameters['fps'] * 60), index=False)
+        elif self.parameters['mono']:
+            self.output = skvideo.io.FFmpegWriter(self.parameters['output_file'],
+                                                  inputdict=self.parameters['ffmpeg_param_in'],
+                                                  outputdict=self.parameters['ffmpeg_param_out'])
+        else:
+            self.output = skvideo.io.FFmpegWriter(self.parameters['output_file'], outputdict=self.parameters['ffmpeg_param_out'])
 
     def set_counter(self):
         """Sets cameras frame counter (Counter1) and resets it."""
@@ -183,42 +214,125 @@ class Camera:
         self.camera.Open()
         self.set_parameters()
         self.grabResult = self.camera.GrabOne(100)
-        image = self.converter.Convert(self.grabResult)
-        img = cv.cvtColor(image.GetArray(), cv.COLOR_BGR2RGB)
+        img = self.preview_image(self.grabResult)
         self.camera.Close()
         return img
 
-    def grab_image(self):
-        """Grab frame data and append timing values to output variale."""
-        if genicam.IsReadable(self.grabResult.ChunkCounterValue):
-            if genicam.IsReadable(self.grabResult.ChunkExposureTime):
-                if genicam.IsReadable(self.grabResult.ChunkTimestamp):
+    def preview_image(self, grabResult):
+        """Returns copy of the grabbed frame for showing it."""
+        if self.parameters['mono']:
+            return grabResult.GetArray()
+        image = self.converter.Convert(grabResult)
+        return cv.cvtColor(image.GetArray(), cv.COLOR_BGR2RGB)
+
+    def start_preview(self):
+        """Opens camera and starts grabbing in a thread for the live preview. Camera is kept open
+        until the preview is stopped."""
+        if self.preview_thread is not None:
+            return
+        self.print_info()
+        self.camera.Open()
+        self.set_parameters()
+        self.camera.StartGrabbing(pylon.GrabStrategy_OneByOne)
+        self.preview_thread = threading.Thread(target=self.preview_grab, daemon=True)
+        self.preview_thread.start()
+
+    def preview_grab(self):
+        """Preview thread. Grabs every frame, but copies only frames for the display rate, so
+        showing them doesn't slow down grabbing."""
+        limiter = RateLimiter(DISPLAY_RATE)
+        while self.camera.IsGrabbing():
+            grabResult = self.camera.RetrieveResult(1000, pylon.TimeoutHandling_Return)
+            # Result is empty on timeout or if grabbing was stopped while waiting
+            if not grabResult.IsValid():
+                continue
+            try:
+                if grabResult.GrabSucceeded() and limiter.ready():
+                    image = self.preview_image(grabResult)
+                    with self.preview_lock:
+                        self.preview_count += 1
+                        self.preview_frame = (image, self.preview_count)
+            finally:
+                grabResult.Release()
+
+    def latest_frame(self):
+        """Returns the latest preview frame and its number or None if there is none yet."""
+        with self.preview_lock:
+            return self.preview_frame
+
+    def stop_preview(self):
+        """Stops the preview thread and closes the camera."""
+        if self.preview_thread is None:
+            return
+        self.camera.StopGrabbing()
+        self.preview_thread.join()
+        self.preview_thread = None
+        self.camera.Close()
+
+    def read_chunks(self, grabResult):
+        """Returns timing values (counter, time in us, exposure time) of the frame from the chunks
+        or None if they are not readable."""
+        if genicam.IsReadable(grabResult.ChunkCounterValue):
+            if genicam.IsReadable(grabResult.ChunkExposureTime):
+                if genicam.IsReadable(grabResult.ChunkTimestamp):
                     if self.first_timestamp == 0:
-                        self.first_timestamp = self.grabResult.ChunkTimestamp.Value
-                    to_us = (self.grabResult.ChunkTimestamp.Value - self.first_timestamp) / 1e3
-                    self.data_out.append((self.grabResult.ChunkCounterValue.Value, round(to_us, 2), self.grabResult.ChunkExposureTime.Value))
-        # print(self.data_out)
-
-        if self.grabResult.GrabSucceeded() and self.imageWindow.IsVisible():
-            self.imageWindow.SetImage(self.grabResult)
-            if self.parameters['record']:
-                image = self.converter.Convert(self.grabResult)
-                img = image.GetArray()
-                # Skvideo write
-                self.output.writeFrame(img)
-                # OpenCV write
-                # self.output.write(img)
-        elif not self.imageWindow.IsVisible():
-                self.camera.StopGrabbing()
-        else:
-            print("Error: ", self.grabResult.ErrorCode)
+                        self.first_timestamp = grabResult.ChunkTimestamp.Value
+                    to_us = (grabResult.ChunkTimestamp.Value - self.first_timestamp) / 1e3
+                    return (grabResult.ChunkCounterValue.Value, round(to_us, 2),
+                            grabResult.ChunkExposureTime.Value)
+        return None
+
+    def grab(self):
+        """Grabs next frame for the recording pipeline. Returns the frame and its timing values or
+        None when grabbing has stopped. Frame is valid until the next grab. Grabbing is stopped
+        when the video window is closed."""
+        while self.camera.IsGrabbing():
+            grabResult = self.camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
+            # Result is empty if grabbing was stopped while waiting
+            if not grabResult.IsValid():
+                continue
+            try:
+                # Check to see if a buffer containing chunk data has been received.
+                if pylon.PayloadType_ChunkData != grabResult.PayloadType:
+                    raise pylon.RUNTIME_EXCEPTION("Unexpected payload type received.")
+                # Since we have activated the CRC Checksum feature, we can check
+                # the integrity of the buffer first.
+                # Note: Enabling the CRC Checksum feature is not a prerequisite for using
+                # chunks. Chunks can also be handled when the CRC Checksum feature is deactivated.
+                if grabResult.HasCRC() and grabResult.CheckCRC() == False:
+                    raise pylon.RUNTIME_EXCEPTION("Image was damaged!")
+                if not self.imageWindow.IsVisible():
+                    self.camera.StopGrabbing()
+                    return None
+                if not grabResult.GrabSucceeded():
+                    print("Error: ", grabResult.ErrorCode)
+                    continue
+                self.counter += 1
+                # Showing every frame would cost frames at high frame rates
+                if self.display.ready():
+                    self.imageWindow.SetImage(grabResult)
+                if self.parameters['mono']:
+                    # Copy of the Mono8 buffer as is
+                    return grabResult.GetArray(), self.read_chunks(grabResult)
+                # Converted image is kept until the next grab, pipeline copies the frame from it
+                self.image = self.converter.Convert(grabResult)
+                return self.image.GetArray(), self.read_chunks(grabResult)
+            finally:
+                # Camera buffer is given back right away
+                grabResult.Release()
+        return None
+
+    def stop(self):
+        """Stops grabbing."""
+        self.camera.StopGrabbing()
 
     def record(self):
         """Toggle when not previewing."""
         self.parameters['record'] = True
 
     def start(self):
-        """Main loop. Setup camera, run, close and save."""
+        """Main loop. Setup camera, run, close and save. Frames are grabbed and encoded in separate
+        threads by the recording pipeline."""
         self.print_info()
 
         self.camera.Open()
@@ -232,26 +346,17 @@ class Camera:
         self.imageWindow.Show()
         self.camera.StartGrabbing(pylon.GrabStrategy_OneByOne)
 
-        while self.camera.IsGrabbing():
-            self.counter  += 1
-            self.grabResult = self.camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
-            # Check to see if a buffer containing chunk data has been received.
-            if pylon.PayloadType_ChunkData != self.grabResult.PayloadType:
-                raise pylon.RUNTIME_EXCEPTION("Unexpected payload type received.")
-            # Since we have activated the CRC Checksum feature, we can check
-            # the integrity of the buffer first.
-            # Note: Enabling the CRC Checksum feature is not a prerequisite for using
-            # chunks. Chunks can also be handled when the CRC Checksum feature is deactivated.
-            if self.grabResult.HasCRC() and self.grabResult.CheckCRC() == False:
-                raise pylon.RUNTIME_EXCEPTION("Image was damaged!")
-            self.grab_image()
-
-        self.camera.Close()
-        with open(self.parameters['output_csv'], 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerows(self.data_out)
-        # self.disable_chunks()
-        # Release OpenCV output file
-        # self.output.release()
-        # Close skvideo file
-        self.output.close()
+        self.log = MetadataLog(self.parameters['output_log'], self.parameters['fps'])
+        pipeline = RecordingPipeline(self, self.output if self.parameters['record'] else None,
+                                     self.ring_size, self.log)
+        try:
+            pipeline.run()
+        finally:
+            self.camera.Close()
+            self.log.close()
+            self.log.print_summary()
+            # self.disable_chunks()
+            # Release OpenCV output file
+            # self.output.release()
+            # Close skvideo file
+            self.output.close()
@@ -1,5 +1,14 @@
 import cv2 as cv
+import numpy as np
+import collections
+import queue
+import threading
+import time
 from frame import Frame
+from profiling import profiled
+
+# FourCC codes of the grayscale pixel formats reported by the FFmpeg backend
+GRAY_FORMATS = ('Y800', 'GREY', 'Y8  ')
 
 """Capture class handles all OpenCV frame capturing from video device or video file."""
 class Capture:
@@ -8,9 +17,18 @@ class Capture:
         """Accepts filename or device id. Capture arguments passed as kwargs."""
         self.source = source_id
         self.capture = cv.VideoCapture(source_id)
+        # Grayscale videos (Mono8 recordings) are read as single channel frames without converting
+        # them to BGR
+        self.gray = is_gray(self.capture)
+        if self.gray:
+            self.reopen()
         self.frame = Frame() # Frame object contains image and frame number, time
         self.total_frames = self.capture.get(cv.CAP_PROP_FRAME_COUNT)
         self.fps = self.capture.get(cv.CAP_PROP_FPS)
+        # FrameIndex of the video file for exact seeking
+        self.index = kwargs['index'] if 'index' in kwargs else None
+        if self.index is not None:
+            self.total_frames = len(self.index)
 
         if 'width' in kwargs:
             self.capture.set(cv.CAP_PROP_FRAME_WIDTH, kwargs['width'])
@@ -19,13 +37,14 @@ class Capture:
         elif 'fps' in kwargs:
             self.capture.set(cv.CAP_PROP_FPS, kwargs['fps'])
         elif 'start_ms' in kwargs:
-            self.capture.set(cv.CAP_PROP_POS_MSEC, kwargs['start_ms'])
+            Capture.seek_ms(self, kwargs['start_ms'])
         # Only for video files
         elif 'start_frame' in kwargs:
-            self.capture.set(cv.CAP_PROP_POS_FRAMES, kwargs['start_frame'])
+            Capture.seek_frame(self, kwargs['start_frame'])
         elif 'fourcc' in kwargs:
             self.capture.set(cv.CAP_PROP_FOURCC, kwargs['fourcc'])
 
+    @profiled
     def capture_frame(self):
         """Handles capturing frame and updating the frame object."""
         try:
@@ -46,11 +65,62 @@ class Capture:
         # Getting 'non-existing PPS 0 referenced' form FFMPEG if starting from 0 msec (x264/mp4)
         # 24 ms from start seems to work
         # self.capture.set(cv.CAP_PROP_POS_MSEC, 24)
-        self.capture.set(cv.CAP_PROP_POS_FRAMES, 24)
+        self.seek_frame(24)
 
         # This breaks timing
         # self.capture = cv.VideoCapture(self.source)
 
+    def seek_frame(self, frame_num):
+        """Sets position so that the next captured frame is frame_num (counted from 0). With frame
+        index the landing frame is checked from its timestamp, and if the seek missed, it is done
+        again from the keyframes before. Seek is exact then."""
+        if self.index is None:
+            self.capture.set(cv.CAP_PROP_POS_FRAMES, frame_num)
+            return
+        if frame_num <= 0:
+            self.reopen()
+            return
+        # Frame before the target is grabbed last
+        last = min(frame_num, len(self.index)) - 1
+        start = last
+        while True:
+            if start == 0:
+                self.reopen()
+            else:
+                self.capture.set(cv.CAP_PROP_POS_FRAMES, start)
+            landed = self.index.find(self.capture.get(cv.CAP_PROP_POS_MSEC)) \
+                if self.capture.grab() else None
+            if landed is not None and landed <= last:
+                break
+            if start == 0:
+                # Landing frame unknown even from the beginning, so trusting the capture
+                self.capture.set(cv.CAP_PROP_POS_FRAMES, frame_num)
+                return
+            start = self.index.keyframe_before(start - 1)
+        for _ in range(last - landed):
+            self.capture.grab()
+
+    def reopen(self):
+        """Opens the video again. Seeking to the beginning of H.264 video doesn't work reliably."""
+        self.capture.release()
+        if self.gray:
+            # OpenCV warns about the turned off conversion on every open
+            level = cv.getLogLevel()
+            cv.setLogLevel(2) # Errors only
+            self.capture = cv.VideoCapture(self.source, cv.CAP_FFMPEG,
+                                           [cv.CAP_PROP_CONVERT_RGB, 0])
+            cv.setLogLevel(level)
+        else:
+            self.capture = cv.VideoCapture(self.source)
+
+    def seek_ms(self, ms):
+        """Sets position so that the next captured frame is the first at or after the time in ms.
+        Exact with frame index."""
+        if self.index is None:
+            self.capture.set(cv.CAP_PROP_POS_MSEC, ms)
+        else:
+            self.seek_frame(self.index.frame_at(ms))
+
     def capture_open(self):
         """To just check if capturing is still open."""
         return self.capture.isOpened()
@@ -72,3 +142,200 @@ class Capture:
     def get_lenght_in_s(self):
         """Returns video length in seconds."""
         return self.total_frames / self.fps
+
+
+"""Capture with a background decode thread. Frames are decoded ahead to a fixed size ring of
+preallocated buffers, so decoding overlaps with the processing of the previous frames. Frame given
+by capture_frame is a ring buffer, valid until the next capture_frame call."""
+class PrefetchCapture(Capture):
+
+    def __init__(self, source_id, ring_size=8, **kwargs):
+        """Accepts filename or device id, ring size (at least 2) and Capture arguments."""
+        super().__init__(source_id, **kwargs)
+        self.ring_size = max(ring_size, 2)
+        self.ring = None # Allocated when the frame size is known
+        self.slot = None # Ring buffer in use by the consumer
+        self.thread = None
+        self.start_decoding()
+
+    def start_decoding(self):
+        """Starts decode thread with all the ring buffers free."""
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for slot in range(self.ring_size):
+            self.free.put(slot)
+        self.slot = None
+        self.thread = threading.Thread(target=self.decode, daemon=True)
+        self.thread.start()
+
+    def stop_decoding(self):
+        """Stops decode thread."""
+        if self.thread is not None:
+            self.free.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def decode(self):
+        """Decode thread. Reads frames to free ring buffers. None marks the end of the video."""
+        while True:
+            slot = self.free.get()
+            if slot is None:
+                return
+            if self.ring is None:
+                ret, img = self.capture.read()
+                if ret:
+                    self.ring = np.empty((self.ring_size,) + img.shape, dtype=img.dtype)
+                    self.ring[slot] = img
+            else:
+                ret, img = self.capture.read(self.ring[slot])
+                if ret and not np.shares_memory(img, self.ring[slot]):
+                    # OpenCV allocated a new image, so copying it to the ring
+                    self.ring[slot] = img
+            if not ret:
+                self.ready.put(None)
+                return
+            self.ready.put((slot, int(self.capture.get(cv.CAP_PROP_POS_FRAMES)),
+                            self.capture.get(cv.CAP_PROP_POS_MSEC)))
+
+    @profiled
+    def capture_frame(self):
+        """Takes next decoded frame from the ring and frees the previous one."""
+        if self.slot is not None:
+            self.free.put(self.slot)
+            self.slot = None
+        decoded = self.ready.get()
+        if decoded is None:
+            self.release_capture()
+            return None
+        self.slot, self.frame.frame_num, self.frame.frame_time = decoded
+        self.frame.frame = self.ring[self.slot]
+        return self.frame.frame
+
+    def seek_frame(self, frame_num):
+        """Stops decoding for the seek and starts again."""
+        self.stop_decoding()
+        super().seek_frame(frame_num)
+        self.start_decoding()
+
+    def seek_ms(self, ms):
+        """Stops decoding for the seek and starts again."""
+        self.stop_decoding()
+        super().seek_ms(ms)
+        self.start_decoding()
+
+    def release_capture(self):
+        """Stops decoding and releases capture."""
+        self.stop_decoding()
+        super().release_capture()
+
+
+"""Capture from a live source (camera) with a background grab thread. Frames are grabbed to a ring
+of preallocated buffers as they arrive. When processing falls behind, the oldest waiting frames are
+dropped, so at most max_queue frames wait and latency stays bounded. A video file can stand in for
+the camera with replay, which delivers frames at the nominal frame rate of the video."""
+class LiveCapture(Capture):
+
+    def __init__(self, source_id, max_queue=2, replay=False, **kwargs):
+        """Accepts device id or filename, maximum count of waiting frames, replay for pacing a video
+        file to its frame rate and Capture arguments."""
+        super().__init__(source_id, **kwargs)
+        self.max_queue = max(max_queue, 1)
+        self.replay = replay
+        # Frames waiting, the one being grabbed and the one in use by the consumer
+        self.ring_size = self.max_queue + 2
+        self.ring = None # Allocated when the frame size is known
+        self.slot = None # Ring buffer in use by the consumer
+        self.free = list(range(self.ring_size))
+        # (slot, frame number, time in ms, grab time) of the waiting frames
+        self.ready = collections.deque()
+        self.condition = threading.Condition()
+        self.grab_count = 0
+        self.dropped = 0
+        self.ended = False
+        self.stopped = False
+        self.capture_time = None # time.perf_counter of the grab of the current frame
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.grab, daemon=True)
+        self.thread.start()
+
+    def grab(self):
+        """Grab thread. Reads frames to free ring buffers and drops the oldest waiting frame if
+        the queue is full."""
+        while not self.stopped:
+            with self.condition:
+                slot = self.free.pop()
+            if self.ring is None:
+                ret, img = self.capture.read()
+                if ret:
+                    self.ring = np.empty((self.ring_size,) + img.shape, dtype=img.dtype)
+                    self.ring[slot] = img
+            else:
+                ret, img = self.capture.read(self.ring[slot])
+                if ret and not np.shares_memory(img, self.ring[slot]):
+                    self.ring[slot] = img
+            if not ret:
+                break
+            self.grab_count += 1
+            if self.replay:
+                # Video file keeps its own numbering and is delivered at the nominal frame rate
+                frame_num = int(self.capture.get(cv.CAP_PROP_POS_FRAMES))
+                frame_time = self.capture.get(cv.CAP_PROP_POS_MSEC)
+                delay = self.start_time + self.grab_count / self.fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                grab_time = time.perf_counter()
+            else:
+                # Gaps in the frame numbers are the dropped frames
+                grab_time = time.perf_counter()
+                frame_num = self.grab_count
+                frame_time = (grab_time - self.start_time) * 1000
+            with self.condition:
+                self.ready.append((slot, frame_num, frame_time, grab_time))
+                if len(self.ready) > self.max_queue:
+                    self.free.append(self.ready.popleft()[0])
+                    self.dropped += 1
+                self.condition.notify()
+        with self.condition:
+            self.ended = True
+            self.condition.notify()
+
+    @profiled
+    def capture_frame(self):
+        """Takes the oldest waiting frame and frees the previous one. Waits for the next frame, if
+        there are no waiting frames."""
+        with self.condition:
+            if self.slot is not None:
+                self.free.append(self.slot)
+                self.slot = None
+            while not self.ready and not self.ended:
+                self.condition.wait()
+            if not self.ready:
+                decoded = None
+            else:
+                decoded = self.ready.popleft()
+        if decoded is None:
+            self.release_capture()
+            return None
+        self.slot, self.frame.frame_num, self.frame.frame_time, self.capture_time = decoded
+        self.frame.frame = self.ring[self.slot]
+        return self.frame.frame
+
+    def seek_frame(self, frame_num):
+        """Live source can't be seeked."""
+        pass
+
+    def release_capture(self):
+        """Stops grabbing and releases capture."""
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        super().release_capture()
+
+
+def is_gray(capture):
+    """Checks if the video file has grayscale pixel format."""
+    code = int(capture.get(cv.CAP_PROP_CODEC_PIXEL_FORMAT))
+    if code <= 0:
+        return False
+    return ''.join(chr((code >> (8 * i)) & 0xFF) for i in range(4)) in GRAY_FORMATS
@@ -0,0 +1,63 @@
+"""Checkpoints for continuing long command line analysis runs."""
+import json
+import os
+from pathlib import Path
+
+
+class Checkpoint:
+    """Saves the analysis state periodically: last analyzed frame, tracking points and the output
+    position. Checkpoint is used only if it was made with the same input video, parameters and
+    output."""
+
+    def __init__(self, filename, input_file, output_file, params, interval=10000):
+        self.filename = Path(filename)
+        self.interval = interval # Frames between the checkpoints
+        input_file = Path(input_file)
+        stat = input_file.stat()
+        # Identifies the analysis run
+        self.run = {'input_file': str(input_file.resolve()),
+                    'input_size': stat.st_size,
+                    'input_mtime': stat.st_mtime,
+                    'output_file': str(Path(output_file).resolve()),
+                    'params': dict(params)}
+
+    def load(self):
+        """Returns saved state or None if there is no checkpoint of this run."""
+        if not self.filename.exists():
+            return None
+        try:
+            with open(self.filename) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            print("Checkpoint could not be read. Starting from the beginning.")
+            return None
+        if checkpoint.get('run') != self.run:
+            print("Checkpoint is from a different input or parameters. Starting from the beginning.")
+            return None
+        return checkpoint['state']
+
+    def is_due(self, frame_num):
+        """Checks if checkpoint should be saved after the frame."""
+        return self.interval > 0 and frame_num % self.interval == 0
+
+    def save(self, frame_num, tracking_points, output_position, row_count):
+        """Saves state after the frame. Output must be synced to the position before saving."""
+        state = {'frame_num': int(frame_num),
+                 'tracking_points': tracking_points,
+                 'output_position': output_position,
+                 'row_count': row_count}
+        # Written to temporary file first, so a crash while saving doesn't break the checkpoint
+        temp_file = self.filename.with_name(self.filename.name + '.tmp')
+        with open(temp_file, 'w') as f:
+            json.dump({'run': self.run, 'state': state}, f, default=_to_json)
+        os.replace(temp_file, self.filename)
+
+    def remove(self):
+        """Removes checkpoint after finished run."""
+        if self.filename.exists():
+            self.filename.unlink()
+
+
+def _to_json(value):
+    """Converts NumPy values of the tracking points for json."""
+    return value.tolist()
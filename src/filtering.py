@@ -1,6 +1,8 @@
 import cv2 as cv
 import numpy as np
+from functools import lru_cache
 from frame import Frame
+from profiling import profiled
 
 """Class for handling all the filtering."""
 class VideoFiltering:
@@ -9,6 +11,7 @@ class VideoFiltering:
         """Adds frame to be filtered. All filtering is done to this frame."""
         self.frame = frame
 
+    @profiled
     def blur(self, value=(7, 7)):
         """"Median blur filter."""
         frame = self.frame.frame
@@ -22,10 +25,13 @@ class VideoFiltering:
         self.frame.frame = frame
         return self.frame.frame
 
+    @profiled
     def brightness_contrast(self, brightness=None, contrast=None):
         """Custom brightness and contrast filter."""
-        frame = self.frame.get_frame_hsv()
-        lum = frame[:, :, 2] # Luminisity from hsv color space frame
+        # Single channel frame is the luminance as is
+        gray = self.frame.frame.ndim == 2
+        frame = self.frame.frame if gray else self.frame.get_frame_hsv()
+        lum = frame if gray else frame[:, :, 2] # Luminisity from hsv color space frame
         if brightness is None and contrast is None:
             brightness = contrast = np.mean(lum)
         lum = cv.multiply(lum, (contrast / 127 + 1))
@@ -34,16 +40,24 @@ class VideoFiltering:
         lum = cv.add(lum, brightness)
 
         # Scale values to 0 - 255
-        lum = cv.subtract(lum, np.asscalar(np.min(lum)))
-        lum = cv.divide(lum, np.asscalar(np.max(lum) / 255))
+        lum = cv.subtract(lum, np.min(lum).item())
+        lum = cv.divide(lum, (np.max(lum) / 255).item())
 
-        frame[:, :, 2] = lum
-        self.frame.set_frame_hsv(frame)
+        if gray:
+            self.frame.frame = lum
+        else:
+            frame[:, :, 2] = lum
+            self.frame.set_frame_hsv(frame)
         return self.frame.frame
 
+    @profiled
     def threshold(self, threshold=127, max_value=255,
                   mode=cv.THRESH_BINARY_INV):
         """Inverted threshold filter."""
+        if self.frame.frame.ndim == 2:
+            if threshold > 0:
+                ret, self.frame.frame = cv.threshold(self.frame.frame, threshold, max_value, mode)
+            return self.frame.frame
         frame = self.frame.get_frame_hsv()
         if threshold > 0:
             ret, frame[:, :, 2] = cv.threshold(frame[:, :, 2], threshold,
@@ -51,11 +65,13 @@ class VideoFiltering:
         self.frame.set_frame_hsv(frame)
         return self.frame.frame
 
+    @profiled
     def frequencies(self):
         """Calculates white pixels from binarized frame."""
-        frame = self.frame.get_frame_hsv ()
-        return np.sum(frame[:, :, 2] / 255, dtype=np.int_)
+        # V of the HSV color space without converting the whole frame
+        return np.sum(self.frame.get_luminance() / 255, dtype=np.int_)
 
+    @profiled
     def resize(self, size):
         """Resize frame to given dimensions."""
         frame = cv.resize(self.frame.frame, size)
@@ -87,11 +103,13 @@ class VideoFiltering:
 
             return {'x': x, 'y': y, 'xw': xw, 'yh': yh}
 
+    @profiled
     def crop_roi(self, points, pad):
         """Crops frame to given dimensions."""
         pt = self.roi(points, pad)
         self.frame.frame = self.frame.frame[pt['y']:pt['yh'], pt['x']:pt['xw']]
 
+    @profiled
     def draw_bounding_box(self, points, pad=0, color=(255, 0, 0), line_thickness=2):
         """Draws rectangle bounding box for given dimensions."""
         if points:
@@ -107,3 +125,208 @@ class VideoFiltering:
         for pt in points[0]:
             frame = cv.circle(frame, tuple(pt), radius, color, line_thickness)
         self.frame.frame = frame
+
+
+"""Single channel filtering. Luminance plane is taken once from the frame and all the filtering is
+done to that plane, so no HSV conversions are needed between the filters. Gives the same white
+pixel count as VideoFiltering, which is kept as the reference implementation."""
+class LuminanceFiltering(VideoFiltering):
+
+    def __init__(self, frame=None):
+        """Output buffers are reused between the frames of the same size."""
+        super().__init__(frame)
+        self.buffers = {}
+        self.allocations = 0 # Count of output buffer (re)allocations, not of all the allocations
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        """Returns output buffer for the filter. New buffer allocated only if the size changes."""
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+            self.allocations += 1
+        return buffer
+
+    @profiled
+    def luminance(self):
+        """Replaces frame with its luminance plane."""
+        frame = self.frame.frame
+        if frame.ndim == 3:
+            # Same as Frame.get_luminance, but to the buffer
+            lum = self.buffer('luminance', frame.shape[:2])
+            np.maximum(frame[:, :, 0], frame[:, :, 1], out=lum)
+            self.frame.frame = np.maximum(lum, frame[:, :, 2], out=lum)
+        return self.frame.frame
+
+    @profiled
+    def blur(self, value=(7, 7)):
+        """"Median blur filter for luminance plane."""
+        if np.sum(value) > 0:
+            # Values should not be dividable by 2
+            if value[0] % 2 == 0:
+                val = value[0] + 1
+            else:
+                val = value[0]
+            lum = self.frame.frame
+            self.frame.frame = cv.medianBlur(lum, val, dst=self.buffer('blur', lum.shape))
+        return self.frame.frame
+
+    @profiled
+    def brightness_contrast(self, brightness=None, contrast=None):
+        """Custom brightness and contrast filter for luminance plane."""
+        lum = self.frame.frame
+        if brightness is None and contrast is None:
+            brightness = contrast = np.mean(lum)
+        lum = _adjust_brightness_contrast(lum, brightness, contrast)
+
+        # Scale values to 0 - 255
+        lum = cv.subtract(lum, int(np.min(lum)))
+        lum = cv.divide(lum, int(np.max(lum)) / 255)
+
+        self.frame.frame = lum
+        return self.frame.frame
+
+    @profiled
+    def threshold(self, threshold=127, max_value=255,
+                  mode=cv.THRESH_BINARY_INV):
+        """Inverted threshold filter for luminance plane."""
+        if threshold > 0:
+            ret, self.frame.frame = cv.threshold(self.frame.frame, threshold, max_value, mode)
+        return self.frame.frame
+
+    @profiled
+    def lut_threshold(self, brightness, contrast, threshold=127, max_value=255,
+                      mode=cv.THRESH_BINARY_INV):
+        """Brightness, contrast and threshold filters as a single lookup table. Same result as
+        running brightness_contrast and threshold, but only one pass over the plane."""
+        if brightness is None and contrast is None:
+            # Mean based values change every frame, no point to cache tables for those
+            self.brightness_contrast()
+            return self.threshold(threshold, max_value, mode)
+        lum = self.frame.frame
+        lum_min, lum_max = cv.minMaxLoc(lum)[:2]
+        table = _threshold_table(brightness, contrast, threshold, max_value, mode,
+                                 int(lum_min), int(lum_max))
+        self.frame.frame = cv.LUT(lum, table, dst=self.buffer('lut', lum.shape))
+        return self.frame.frame
+
+    @profiled
+    def resize(self, size):
+        """Resize luminance plane to given dimensions."""
+        self.frame.frame = cv.resize(self.frame.frame, size,
+                                     dst=self.buffer('resize', (size[1], size[0])))
+        return self.frame.frame
+
+    @profiled
+    def white_thresholds(self, size):
+        """Replaces brightness/contrast filtered (unthresholded) luminance plane with the lowest
+        threshold at which each pixel is white after thresholding and resizing to given dimensions.
+        Histogram of it is the same as white pixel counts of all the thresholds (except 0)."""
+        lum = self.frame.frame
+        rows, cols, table = _resize_taps(lum.shape, size)
+        # Values of the four source pixels of each resized pixel
+        values = lum[rows[:, None, :, None], cols[None, :, None, :]].reshape(4, -1)
+        # Table rows of the resized pixels
+        offsets = np.arange(0, 16 * values.shape[1], 16, dtype=np.int32)
+        levels = self.buffer('levels', (size[1], size[0]))
+        levels.fill(255)
+        for i, value in enumerate(values):
+            # Source pixels above the value are black at the threshold of the value
+            black = np.zeros(value.shape, dtype=np.uint8)
+            for bit, other in enumerate(values):
+                if bit != i:
+                    black |= np.greater(other, value).view(np.uint8) << bit
+            np.minimum(levels, value.reshape(levels.shape), out=levels,
+                       where=table[offsets + black].reshape(levels.shape))
+        self.frame.frame = levels
+        return self.frame.frame
+
+    @profiled
+    def frequencies(self):
+        """Calculates white pixels from binarized luminance plane."""
+        lum = self.frame.frame
+        return np.count_nonzero(np.equal(lum, 255, out=self.buffer('white', lum.shape, bool)))
+
+    @profiled
+    def histogram(self):
+        """Returns 256 bin histogram of the luminance plane."""
+        return np.bincount(self.frame.frame.ravel(), minlength=256)
+
+    def eye_area(self, points, pad):
+        """Crops frame to the eye area, if found, and takes its luminance plane."""
+        if points:
+            self.crop_roi(points, pad)
+        return self.luminance()
+
+    def binarize(self, params, blur=True, threshold=None):
+        """Filters luminance plane of the eye area with the analysis parameters (dict as in the
+        parameters file) to the binarized output. Blur is skipped for already blurred planes.
+        Threshold overrides the threshold of the parameters, 0 leaves the plane unthresholded."""
+        if blur:
+            self.blur((params['blur_val'], params['blur_val']))
+        if threshold is None:
+            threshold = params['thres_val']
+        self.lut_threshold(params['b_val'], params['c_val'], threshold)
+        return self.resize((params['area_x'], params['area_y']))
+
+    def process(self, params, points):
+        """Runs the whole output filtering chain for the captured frame: eye area, luminance, blur,
+        brightness, contrast, threshold and resize. White pixels are counted with frequencies."""
+        self.eye_area(points, params['pad_val'])
+        return self.binarize(params)
+
+
+def _adjust_brightness_contrast(lum, brightness, contrast):
+    """Brightness and contrast adjustment of the luminance plane without the scaling."""
+    lum = cv.multiply(lum, (contrast / 127 + 1))
+    lum = cv.subtract(lum, contrast)
+    return cv.add(lum, brightness)
+
+@lru_cache(maxsize=64)
+def _resize_taps(shape, size):
+    """Source pixels of the linear resize from shape to size (width, height) for
+    LuminanceFiltering.white_thresholds. Returns source rows and columns (2 x height and 2 x width)
+    and flattened table (height x width x 16) of the resized pixels staying white with each set of
+    their source pixels black. Bit 2 * i + j of the set is the source pixel from rows[i] and
+    cols[j]."""
+    def taps(length, resized):
+        x = (np.arange(resized) + 0.5) * length / resized - 0.5
+        x0 = np.clip(np.floor(x).astype(np.intp), 0, length - 1)
+        return np.stack((x0, np.minimum(x0 + 1, length - 1)))
+    rows, cols = taps(shape[0], size[1]), taps(shape[1], size[0])
+
+    # Neighbouring source pixels differ in parity, so blacking source pixels by the parity of
+    # their row and column tests all the sets of the resized pixels at once
+    parity = 2 * (np.arange(shape[0]) % 2)[:, None] + np.arange(shape[1]) % 2
+    stays_white = np.empty((16, size[1], size[0]), dtype=bool)
+    for classes in range(16):
+        black = (classes >> parity) & 1
+        plane = np.where(black, 0, 255).astype(np.uint8)
+        stays_white[classes] = cv.resize(plane, size) == 255
+
+    # Parity classes of the source pixels of each resized pixel
+    pixel_classes = 2 * (rows % 2)[:, None, :, None] + (cols % 2)[None, :, None, :]
+    pixel_classes = pixel_classes.reshape(4, size[1], size[0])
+    table = np.empty((16, size[1], size[0]), dtype=bool)
+    for pixels in range(16):
+        classes = np.zeros((size[1], size[0]), dtype=np.intp)
+        for bit in range(4):
+            if pixels >> bit & 1:
+                classes |= 1 << pixel_classes[bit]
+        table[pixels] = np.take_along_axis(stays_white, classes[None], axis=0)[0]
+    return rows, cols, np.moveaxis(table, 0, -1).ravel()
+
+@lru_cache(maxsize=1024)
+def _threshold_table(brightness, contrast, threshold, max_value, mode, lum_min, lum_max):
+    """Builds lookup table for LuminanceFiltering.lut_threshold. Scaling to 0 - 255 depends on the
+    min and max of the frame, so those are part of the cache key."""
+    table = _adjust_brightness_contrast(np.arange(256, dtype=np.uint8).reshape(1, 256),
+                                        brightness, contrast)
+    # Adjustment is monotonic, so frame min and max are mapped to the min and max after it
+    adj_min = int(table[0, lum_min])
+    adj_max = int(table[0, lum_max])
+    table = cv.subtract(table, adj_min)
+    table = cv.divide(table, (adj_max - adj_min) / 255)
+    if threshold > 0:
+        ret, table = cv.threshold(table, threshold, max_value, mode)
+    return table
@@ -1,5 +1,6 @@
 from copy import copy, deepcopy
 import cv2 as cv
+import numpy as np
 
 """Handles the frame information."""
 class Frame:
@@ -17,6 +18,14 @@ class Frame:
         """Sets HSV frame as objects frame in BGR format."""
         self.frame = cv.cvtColor(frame, cv.COLOR_HSV2BGR)
 
+    def get_luminance(self):
+        """Returns luminance (V channel of HSV) plane of the frame. Single channel frames are
+        returned as is."""
+        if self.frame.ndim == 2:
+            return self.frame
+        # V of the OpenCV HSV color space is the maximum of the B, G and R channels
+        return np.maximum(np.maximum(self.frame[:, :, 0], self.frame[:, :, 1]), self.frame[:, :, 2])
+
     def get_frame_size(self):
         """Return frame size as tuple."""
         return (self.frame.shape[1], self.frame.shape[0])
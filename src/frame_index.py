@@ -0,0 +1,102 @@
+"""Frame index of a video file for exact and fast seeking."""
+import os
+import numpy as np
+import cv2 as cv
+from pathlib import Path
+
+
+class FrameIndex:
+    """Keyframe positions and timestamps of all the frames of a video. Built once by reading the
+    video without decoding the images and saved next to it. Seeking starts from the keyframe before
+    the frame, so only the frames between them are decoded, and the landing frame is checked from
+    its timestamp."""
+
+    def __init__(self, keyframes, timestamps, video=None):
+        """Accepts keyframe indices (counted from 0), timestamp in ms of every frame as reported by
+        the capture and identity of the video (size and modification time)."""
+        self.keyframes = np.asarray(keyframes, dtype=np.int64)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.video = video
+        # Half of the frame interval, timestamps reported after seeking may differ slightly
+        self.tolerance = 0.5 * np.median(np.diff(self.timestamps)) if len(self.timestamps) > 1 \
+            else 1e-3
+
+    @classmethod
+    def build(cls, video_file):
+        """Reads the video and returns its index. Videos without keyframe information (other than
+        FFmpeg backend) get only the first frame as a keyframe."""
+        capture = cv.VideoCapture(str(video_file))
+        keyframes = []
+        timestamps = []
+        while capture.grab():
+            if capture.get(cv.CAP_PROP_LRF_HAS_KEY_FRAME) > 0:
+                keyframes.append(len(timestamps))
+            timestamps.append(capture.get(cv.CAP_PROP_POS_MSEC))
+        capture.release()
+        if not keyframes or keyframes[0] != 0:
+            keyframes.insert(0, 0)
+        return cls(keyframes, timestamps, video_identity(video_file))
+
+    @classmethod
+    def load(cls, filename):
+        """Loads saved index."""
+        with np.load(str(filename)) as data:
+            return cls(data['keyframes'], data['timestamps'],
+                       (int(data['video'][0]), float(data['video'][1])))
+
+    @classmethod
+    def open(cls, video_file, build=True):
+        """Returns index of the video. Saved index is used if it matches the video, otherwise index
+        is built and saved if build is set. Returns None if there is no index."""
+        filename = index_filename(video_file)
+        if filename.exists():
+            index = cls.load(filename)
+            if index.video == video_identity(video_file):
+                return index
+            print("Frame index is outdated.")
+        if not build:
+            return None
+        print("Building frame index of '{}'.".format(video_file))
+        index = cls.build(video_file)
+        index.save(filename)
+        return index
+
+    def save(self, filename):
+        """Saves index to a NumPy .npz file."""
+        # Written to temporary file first, so a crash doesn't leave broken index
+        temp_file = Path(filename).with_name(Path(filename).name + '.tmp.npz')
+        np.savez(str(temp_file), keyframes=self.keyframes, timestamps=self.timestamps,
+                 video=np.array(self.video, dtype=np.float64))
+        os.replace(str(temp_file), str(filename))
+
+    def keyframe_before(self, frame):
+        """Returns the last keyframe at or before the frame."""
+        return int(self.keyframes[np.searchsorted(self.keyframes, frame, side='right') - 1])
+
+    def frame_at(self, ms):
+        """Returns the first frame at or after the time in ms."""
+        return int(min(np.searchsorted(self.timestamps, ms), len(self.timestamps) - 1))
+
+    def find(self, ms):
+        """Returns the frame with the timestamp or None if there is no such frame."""
+        frame = int(np.searchsorted(self.timestamps, ms))
+        for candidate in (frame - 1, frame):
+            if 0 <= candidate < len(self.timestamps) and \
+                    abs(self.timestamps[candidate] - ms) < self.tolerance:
+                return candidate
+        return None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+def index_filename(video_file):
+    """Index is saved next to the video."""
+    video_file = Path(video_file)
+    return video_file.parent / (video_file.stem + "_index.npz")
+
+
+def video_identity(video_file):
+    """Size and modification time of the video for checking that the index is up to date."""
+    stat = Path(video_file).stat()
+    return (int(stat.st_size), float(stat.st_mtime))
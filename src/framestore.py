@@ -0,0 +1,243 @@
+"""Raw frame store: lossless recording target without encoding, and a Capture compatible reader
+for analyzing it without decoding. Frames are appended to a preallocated memory-mapped file after a
+small header. Timing values of the frames are saved to an index next to it, which is the same
+file as the metadata log of the recorder."""
+import sys
+import argparse
+import struct
+import numpy as np
+from pathlib import Path
+from frame import Frame
+from results import NpyAppender
+
+MAGIC = b'BLINKRAW'
+VERSION = 1
+# Header is padded to a page, so the frames are page aligned
+HEADER_LENGTH = 4096
+# Magic, version, width, height, channels, dtype, fps, capacity and frame count
+HEADER_FORMAT = '<8sIIII4sdQQ'
+COUNT_OFFSET = struct.calcsize(HEADER_FORMAT) - 8
+# Index row of the frame: camera counter, time stamp in us and exposure time in us
+INDEX_DTYPE = np.dtype([('counter', '<i8'), ('timestamp', '<f8'), ('exposure_time', '<f8')])
+
+
+def index_filename(filename):
+    """Index is saved next to the store. Recorder writes its metadata log (recording.MetadataLog)
+    with the same name and rows, so the log of a recording is the index of its store."""
+    filename = Path(filename)
+    return filename.parent / (filename.stem + "_recording.npy")
+
+
+class FrameStoreWriter:
+    """Appends frames to a raw frame store. File is preallocated for capacity frames and grown when
+    it is full (remapping is slow, so capacity should cover the recording). Frame count in the
+    header is updated with every frame, so the store is readable up to the last written frame even
+    after a crash. Has writeFrame of skvideo.io.FFmpegWriter, so it works as the writer of the
+    recording pipeline."""
+
+    # Recording pipeline passes the timing values of the frames to writeFrame
+    accepts_metadata = True
+
+    def __init__(self, filename, shape, fps, capacity=30000, dtype=np.uint8, index=True):
+        """Accepts shape of one frame (height, width) or (height, width, channels), frame rate,
+        capacity in frames and if the index is written. Index is not needed when the recording
+        pipeline writes the metadata log."""
+        self.filename = Path(filename)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.fps = fps
+        self.capacity = max(int(capacity), 1)
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.count = 0
+        channels = self.shape[2] if len(self.shape) == 3 else 1
+        header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, self.shape[1], self.shape[0], channels,
+                             self.dtype.str.encode('ascii').ljust(4), fps, self.capacity, 0)
+        with open(self.filename, 'wb') as f:
+            f.write(header.ljust(HEADER_LENGTH, b'\0'))
+            f.truncate(HEADER_LENGTH + self.capacity * self.frame_bytes)
+        self.map_file()
+        self.index = NpyAppender(index_filename(filename), INDEX_DTYPE) if index else None
+
+    def map_file(self):
+        """Memory-maps the header and the frames."""
+        self.map = np.memmap(self.filename, np.uint8, 'r+',
+                             shape=(HEADER_LENGTH + self.capacity * self.frame_bytes,))
+        self.frames = self.map[HEADER_LENGTH:].view(self.dtype).reshape((self.capacity,)
+                                                                         + self.shape)
+        self.header_count = self.map[COUNT_OFFSET:COUNT_OFFSET + 8].view('<u8')
+        self.header_capacity = self.map[COUNT_OFFSET - 8:COUNT_OFFSET].view('<u8')
+
+    def grow(self):
+        """Doubles the capacity of the file."""
+        self.map.flush()
+        del self.frames, self.header_count, self.header_capacity
+        self.map = None
+        self.capacity *= 2
+        with open(self.filename, 'r+b') as f:
+            f.truncate(HEADER_LENGTH + self.capacity * self.frame_bytes)
+        self.map_file()
+        self.header_capacity[0] = self.capacity
+
+    def writeFrame(self, image, metadata=None):
+        """Copies frame to the store. Metadata is (counter, time stamp in us, exposure time) of the
+        frame from the camera."""
+        if self.count >= self.capacity:
+            self.grow()
+        self.frames[self.count] = image
+        if self.index is not None:
+            if metadata is None:
+                metadata = (self.count + 1, self.count / self.fps * 1e6, np.nan)
+            self.index.append([tuple(metadata)])
+        self.count += 1
+        self.header_count[0] = self.count
+
+    def flush(self):
+        self.map.flush()
+        if self.index is not None:
+            self.index.flush()
+
+    def close(self):
+        """Flushes the frames and the index. Unused preallocated space is cut from the file."""
+        if self.map is not None:
+            self.header_capacity[0] = self.count
+            self.map.flush()
+            del self.frames, self.header_count, self.header_capacity
+            self.map = None
+            self.capacity = self.count
+            with open(self.filename, 'r+b') as f:
+                f.truncate(HEADER_LENGTH + self.count * self.frame_bytes)
+        if self.index is not None:
+            self.index.close()
+
+
+class RawCapture:
+    """Reads raw frame store with the interface of Capture. Frames are views of the memory-mapped
+    file, so there is no decoding or copying. Frame time is from the index (camera time stamps) or
+    from the frame rate."""
+
+    def __init__(self, source_id, **kwargs):
+        """Accepts store filename and start_frame or start_ms as Capture."""
+        self.source = source_id
+        with open(source_id, 'rb') as f:
+            header = struct.unpack(HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT)))
+        magic, version, width, height, channels, dtype, self.fps, capacity, count = header
+        if magic != MAGIC or version != VERSION:
+            raise IOError("Not a raw frame store: '{}'".format(source_id))
+        dtype = np.dtype(dtype.decode('ascii').strip())
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        if count > 0:
+            self.frames = np.memmap(source_id, dtype, 'r', offset=HEADER_LENGTH,
+                                    shape=(capacity,) + shape)[:count]
+        else:
+            # Empty file can't be memory-mapped
+            self.frames = np.empty((0,) + shape, dtype)
+        self.total_frames = count
+        self.times = np.arange(count) * (1000 / self.fps)
+        index_file = index_filename(source_id)
+        if index_file.exists():
+            timestamps = np.load(index_file, mmap_mode='r')['timestamp']
+            if len(timestamps) >= count:
+                self.times = np.asarray(timestamps[:count]) / 1000
+        self.position = 0 # Next frame
+        self.opened = True
+        self.frame = Frame()
+        self.gray = channels == 1
+        self.index = None
+        if 'start_ms' in kwargs:
+            self.seek_ms(kwargs['start_ms'])
+        elif 'start_frame' in kwargs:
+            self.seek_frame(kwargs['start_frame'])
+
+    def capture_frame(self):
+        """Takes next frame. Frame number is counted from 1 as in Capture."""
+        if not self.opened or self.position >= self.total_frames:
+            self.release_capture()
+            return None
+        self.frame.frame = self.frames[self.position]
+        self.frame.frame_time = float(self.times[self.position])
+        self.position += 1
+        self.frame.frame_num = self.position
+        return self.frame.frame
+
+    def reset(self):
+        """Starts from the same frame as Capture.reset."""
+        self.seek_frame(24)
+
+    def seek_frame(self, frame_num):
+        """Sets position so that the next captured frame is frame_num (counted from 0)."""
+        self.position = min(max(int(frame_num), 0), self.total_frames)
+
+    def seek_ms(self, ms):
+        """Sets position to the first frame at or after the time in ms."""
+        self.seek_frame(np.searchsorted(self.times, ms))
+
+    def capture_open(self):
+        return self.opened
+
+    def release_capture(self):
+        print('Releasing capture or video. Exiting...')
+        self.opened = False
+
+    def get_total_frames(self):
+        return self.total_frames
+
+    def get_fps(self):
+        return self.fps
+
+    def get_lenght_in_s(self):
+        return self.total_frames / self.fps
+
+
+def transcode(raw_file, output_file, crf=8):
+    """Encodes raw frame store to a video file (H.264 with FFmpeg as in the recorder). Without
+    scikit-video OpenCV's MPEG-4 encoder is used."""
+    cap = RawCapture(raw_file)
+    try:
+        import skvideo.io
+        outputdict = {'-vcodec': 'libx264', '-preset': 'ultrafast', '-crf': str(crf),
+                      '-r': str(cap.get_fps())}
+        inputdict = {'-r': str(cap.get_fps())}
+        if cap.gray:
+            inputdict['-pix_fmt'] = outputdict['-pix_fmt'] = 'gray'
+        writer = skvideo.io.FFmpegWriter(str(output_file), inputdict=inputdict,
+                                         outputdict=outputdict)
+    except ImportError:
+        from recording import OpenCVWriter
+        print("scikit-video not found, encoding with OpenCV (mp4v).")
+        shape = cap.frames.shape
+        writer = OpenCVWriter(output_file, cap.get_fps(), (shape[2], shape[1]), 'mp4v',
+                              color=not cap.gray)
+    frames = 0
+    while cap.capture_open():
+        if cap.capture_frame() is None:
+            break
+        writer.writeFrame(cap.frame.frame)
+        frames += 1
+        if frames % 1000 == 0:
+            print("Encoded frame {} / {}".format(frames, cap.get_total_frames()), end='\r')
+    writer.close()
+    return frames
+
+
+def main():
+    """Transcodes raw frame stores to video files."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', nargs='+', help='raw frame store files')
+    parser.add_argument('-o', '--output', help='define output video (only with one input), named '
+                                               'after the store by default')
+    parser.add_argument('--crf', type=int, default=8, help='quality for H.264 (lower is better)')
+    args = parser.parse_args()
+    if args.output and len(args.input) > 1:
+        sys.exit("Output file can be given only for one input!")
+
+    for raw_file in args.input:
+        raw_file = Path(raw_file)
+        if not raw_file.exists():
+            sys.exit("Raw file '{}' not found!".format(raw_file))
+        output_file = Path(args.output) if args.output else raw_file.with_suffix('.mp4')
+        frames = transcode(raw_file, output_file, args.crf)
+        print("\nEncoded {} frames from '{}' to '{}'".format(frames, raw_file, output_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Opt-in instrumentation of the hot paths. Decorated functions are timed only when the profiler
+is enabled, so the overhead is one check per call otherwise."""
+import functools
+import json
+import math
+import time
+
+# Latency histogram bins per doubling of the time and the time of the first bin
+BINS_PER_OCTAVE = 8
+FIRST_BIN = 1e-7 # Seconds
+BIN_COUNT = BINS_PER_OCTAVE * 30
+
+
+class Profiler:
+    """Collects cumulative time, call count and latency histogram of the stages."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.stages = {}
+
+    def record(self, name, seconds):
+        """Adds one call of the stage."""
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {'calls': 0, 'total': 0.0, 'histogram': [0] * BIN_COUNT}
+        stage['calls'] += 1
+        stage['total'] += seconds
+        if seconds > FIRST_BIN:
+            index = min(int(math.log2(seconds / FIRST_BIN) * BINS_PER_OCTAVE), BIN_COUNT - 1)
+        else:
+            index = 0
+        stage['histogram'][index] += 1
+
+    def percentile(self, name, percent):
+        """Returns latency of the stage at the percentile. Accurate to the histogram bin."""
+        stage = self.stages[name]
+        limit = stage['calls'] * percent / 100
+        count = 0
+        for index, bin_count in enumerate(stage['histogram']):
+            count += bin_count
+            if count >= limit:
+                # Upper edge of the bin
+                return FIRST_BIN * 2 ** ((index + 1) / BINS_PER_OCTAVE)
+        return 0.0
+
+    def summary(self):
+        """Returns calls, total time, mean, p50 and p99 latency (seconds) of the stages."""
+        return {name: {'calls': stage['calls'],
+                       'total': stage['total'],
+                       'mean': stage['total'] / stage['calls'],
+                       'p50': self.percentile(name, 50),
+                       'p99': self.percentile(name, 99)}
+                for name, stage in self.stages.items()}
+
+    def print_summary(self):
+        """Prints summary table sorted by the total time."""
+        summary = sorted(self.summary().items(), key=lambda item: item[1]['total'], reverse=True)
+        print("\n{:<36}{:>10}{:>12}{:>12}{:>12}".format("Stage", "Calls", "Total s", "p50 ms",
+                                                     "p99 ms"))
+        for name, stage in summary:
+            print("{:<36}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+                name, stage['calls'], stage['total'], stage['p50'] * 1e3, stage['p99'] * 1e3))
+
+    def save(self, filename):
+        """Writes summary and latency histograms to json file."""
+        trace = {'bins_per_octave': BINS_PER_OCTAVE,
+                 'first_bin': FIRST_BIN,
+                 'summary': self.summary(),
+                 'histograms': {name: stage['histogram'] for name, stage in self.stages.items()}}
+        with open(filename, 'w') as f:
+            json.dump(trace, f, indent=2)
+
+
+# Profiler of the process
+profiler = Profiler()
+
+
+def profiled(function):
+    """Decorator for timing the function with the profiler. Stage is named by the function."""
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not profiler.enabled:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.record(name, time.perf_counter() - start)
+    return wrapper
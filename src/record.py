@@ -1,13 +1,16 @@
 """Quick and dirty high speed video recording application for Basler USB-cameras. Needs rework, but
 works."""
-from camera import Camera
+from camera import Camera, DISPLAY_RATE
 import tkinter as tk
 import tkinter.filedialog
 from PIL import Image, ImageTk
 
 
 def close_app():
-    """Destroy GUI."""
+    """Stops preview and destroys GUI."""
+    if preview_job is not None:
+        window.after_cancel(preview_job)
+    cam.stop_preview()
     window.destroy()
 
 def create_entry(default, text="Add text!"):
@@ -23,7 +26,7 @@ def create_entry(default, text="Add text!"):
 
 def ask_file(file_title):
     """Asks output file name."""
-    return tk.filedialog.asksaveasfilename(title = "file_title", defaultextension='.mp4', filetypes = (("video files","*.mp4"),("all files","*.*")))
+    return tk.filedialog.asksaveasfilename(title = "file_title", defaultextension='.mp4', filetypes = (("video files","*.mp4"),("raw frame store","*.raw"),("all files","*.*")))
 
 def set_parameters():
     """Updates parameters from text entries and updates cameras settings."""
@@ -31,13 +34,26 @@ def set_parameters():
     parameters['height'] = int(height.get())
     parameters['fps'] = float(fps.get())
     parameters['exposure_time'] = float(exposure_time.get())
+    cam.stop_preview()
     cam.update_parameters(parameters)
     preview_video()
 
 def preview_video():
-    """Updates preview image from camera. Grabs one frame. Fix to support live stream."""
-    global preview_label
-    preview = Image.fromarray(cam.grab_one())
+    """Starts live preview from camera. Camera is grabbed at full rate in a thread and the latest
+    frame is shown DISPLAY_RATE times per second."""
+    cam.start_preview()
+    if preview_job is None:
+        update_preview()
+
+def update_preview():
+    """Shows the latest preview frame, if there is a new one, and schedules the next update."""
+    global preview_label, preview_job, preview_shown
+    preview_job = window.after(int(1000 / DISPLAY_RATE), update_preview)
+    latest = cam.latest_frame()
+    if latest is None or latest[1] == preview_shown:
+        return
+    preview_shown = latest[1]
+    preview = Image.fromarray(latest[0])
     prev_img = ImageTk.PhotoImage(preview)
     if preview_label is None:
         preview_label = tk.Label(right, image=prev_img)
@@ -75,6 +91,8 @@ params = tk.Frame(left)
 params.pack(side='top', fill='x')
 
 preview_label = None
+preview_job = None # Scheduled preview update
+preview_shown = 0 # Number of the shown preview frame
 record = False
 
 width = create_entry(160, "Width:")
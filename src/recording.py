@@ -0,0 +1,361 @@
+"""Producer/consumer recording pipeline. Frames are grabbed and encoded in separate threads, so a
+stall in the encoder doesn't back up the camera. Timing values of the recorded frames are streamed
+to a binary log, which detects dropped frames while recording. Has no pypylon dependency: Camera is
+one grab source and SimulatedCamera stands in for it in tests."""
+import sys
+import argparse
+import queue
+import threading
+import time
+import cv2 as cv
+import numpy as np
+from framestore import FrameStoreWriter, INDEX_DTYPE, index_filename
+from results import BatchWriter, NpyAppender
+from utils import RateLimiter
+
+
+class RecordingPipeline:
+    """Grab thread copies frames from the source to a large preallocated ring and the encoder thread
+    writes them from the ring in order. Grab thread never waits for the encoder: if the ring is
+    full, the frame is dropped and counted. Queue depth and its high-water mark are tracked.
+
+    Source has grab() returning (image, metadata) or None when grabbing has ended, and stop().
+    Writer has writeFrame(image) (skvideo.io.FFmpegWriter) or is None for not recording. Writers
+    with accepts_metadata get the metadata too, writeFrame(image, metadata). Metadata of the written
+    frames is appended to the log (MetadataLog), if given."""
+
+    def __init__(self, source, writer=None, ring_size=1000, log=None):
+        self.source = source
+        self.writer = writer
+        self.log = log
+        self.pass_metadata = getattr(writer, 'accepts_metadata', False)
+        self.ring_size = max(ring_size, 2)
+        self.ring = None # Allocated when the frame size is known
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for slot in range(self.ring_size):
+            self.free.put(slot)
+        self.grabbed = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0 # Frames the writer failed to write
+        self.high_water = 0
+        self.grab_thread = None
+        self.encode_thread = None
+        self.error = None
+
+    def start(self):
+        """Starts grab and encoder threads."""
+        self.grab_thread = threading.Thread(target=self.grab, daemon=True)
+        self.encode_thread = threading.Thread(target=self.encode, daemon=True)
+        self.encode_thread.start()
+        self.grab_thread.start()
+
+    def grab(self):
+        """Grab thread. Copies frames to the free ring buffers. None marks the end for the
+        encoder."""
+        try:
+            while True:
+                grabbed = self.source.grab()
+                if grabbed is None:
+                    break
+                image, metadata = grabbed
+                self.grabbed += 1
+                try:
+                    slot = self.free.get_nowait()
+                except queue.Empty:
+                    self.dropped += 1
+                    continue
+                if self.ring is None:
+                    self.ring = np.empty((self.ring_size,) + image.shape, dtype=image.dtype)
+                self.ring[slot] = image
+                self.ready.put((slot, metadata))
+                self.high_water = max(self.high_water, self.ready.qsize())
+        except Exception as error:
+            self.error = error
+        finally:
+            self.ready.put(None)
+
+    def encode(self):
+        """Encoder thread. Writes frames from the ring until the grab thread has ended. If writing
+        fails, grabbing is stopped. Only the written frames are counted and logged."""
+        while True:
+            grabbed = self.ready.get()
+            if grabbed is None:
+                return
+            slot, metadata = grabbed
+            try:
+                if self.pass_metadata:
+                    self.writer.writeFrame(self.ring[slot], metadata)
+                elif self.writer is not None:
+                    self.writer.writeFrame(self.ring[slot])
+            except Exception as error:
+                self.error = error
+                self.failed += 1
+                self.source.stop()
+            else:
+                self.written += 1
+                if self.log is not None and metadata is not None:
+                    self.log.append(metadata)
+            self.free.put(slot)
+
+    def depth(self):
+        """Frames waiting for the encoder."""
+        return self.ready.qsize()
+
+    def running(self):
+        return self.encode_thread is not None and self.encode_thread.is_alive()
+
+    def stop(self):
+        """Stops the source and waits for the encoder to write the grabbed frames."""
+        self.source.stop()
+        if self.grab_thread is not None:
+            self.grab_thread.join()
+        if self.encode_thread is not None:
+            self.encode_thread.join()
+
+    def run(self, report_interval=1.0):
+        """Starts the pipeline and waits until grabbing ends or Ctrl+C is pressed. Prints queue depth
+        every report interval (seconds)."""
+        self.start()
+        try:
+            while self.running():
+                self.encode_thread.join(report_interval)
+                if self.running():
+                    self.print_status(end='\r')
+        except KeyboardInterrupt:
+            print("\nStopped by the user.")
+        self.stop()
+        self.print_status()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """Returns frame counts, queue depth and high-water mark."""
+        return {'grabbed': self.grabbed,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'depth': self.depth(),
+                'high_water': self.high_water,
+                'ring_size': self.ring_size}
+
+    def print_status(self, end='\n'):
+        print("Grabbed {grabbed}, written {written}, dropped {dropped} frames. Queue {depth} / "
+              "{ring_size}, high-water {high_water}".format(**self.stats()), end=end)
+
+
+class MetadataLog(BatchWriter):
+    """Streams timing values (counter, timestamp in us, exposure time in us) of the recorded frames
+    to a .npy file while recording. Rows are written in batches and the file is flushed
+    periodically, so a crash loses only the last rows, and the file can be loaded with numpy.load
+    at any time. Gaps in the camera counter are dropped frames (by the camera or the pipeline) and
+    are reported while recording. Frame intervals deviating from the frame rate more than the
+    jitter tolerance (fraction of the interval) are counted as jitter."""
+
+    def __init__(self, filename, fps, jitter_tolerance=0.25, batch_size=500, flush_interval=1.0):
+        super().__init__(filename, batch_size, flush_interval)
+        self.interval = 1e6 / fps # Frame interval in us
+        self.jitter_tolerance = jitter_tolerance
+        self.appender = None
+        self.last = None # Counter and timestamp of the previous frame
+        self.gaps = [] # (last counter before, first counter after, missing frames)
+        self.dropped = 0
+        self.jitter_count = 0
+        self.max_jitter = 0.0 # us
+        self.report = RateLimiter(1) # Live reports at most once per second
+
+    def open(self, position=None):
+        """Opens the log file. With position (row count) existing log is continued after that many
+        rows."""
+        self.appender = NpyAppender(self.filename, INDEX_DTYPE, length=position)
+
+    def append(self, row):
+        """Checks and adds timing values of the frame to the log."""
+        self.check(row[0], row[1])
+        super().append(tuple(row))
+
+    def check(self, counter, timestamp):
+        """Detects counter gaps and timestamp jitter against the previous frame."""
+        if self.last is not None:
+            frames = counter - self.last[0]
+            if frames != 1:
+                self.gaps.append((self.last[0], counter, frames - 1))
+                self.dropped += max(frames - 1, 0)
+                if self.report.ready():
+                    print("\nDropped frames after counter {}, {} dropped in total."
+                          .format(self.last[0], self.dropped))
+            # Timestamps should advance one interval for each counted frame
+            jitter = abs(timestamp - self.last[1] - frames * self.interval)
+            self.max_jitter = max(self.max_jitter, jitter)
+            if jitter > self.jitter_tolerance * self.interval:
+                self.jitter_count += 1
+        self.last = (counter, timestamp)
+
+    def write_batch(self, rows):
+        self.appender.append(rows)
+
+    def flush_output(self):
+        self.appender.flush()
+
+    def close_output(self):
+        self.appender.close()
+        self.appender = None
+
+    def position(self):
+        """Row count of the log."""
+        return self.row_count
+
+    def summary(self):
+        """Returns frame counts, counter gaps and timestamp jitter."""
+        return {'frames': self.row_count,
+                'dropped': self.dropped,
+                'gaps': self.gaps,
+                'jitter_count': self.jitter_count,
+                'max_jitter': self.max_jitter}
+
+    def print_summary(self, max_gaps=20):
+        """Prints dropped frames as counter ranges (at most max_gaps of them) and jitter."""
+        print("Logged {} frames to '{}', {} dropped in {} gaps.".format(
+            self.row_count, self.filename, self.dropped, len(self.gaps)))
+        for before, after, missing in self.gaps[:max_gaps]:
+            if missing == 1:
+                print("  Dropped 1 frame: counter {}".format(before + 1))
+            elif missing > 1:
+                print("  Dropped {} frames: counter {} - {}".format(missing, before + 1, after - 1))
+            else:
+                print("  Counter went from {} to {}".format(before, after))
+        if len(self.gaps) > max_gaps:
+            print("  ... and {} more gaps".format(len(self.gaps) - max_gaps))
+        print("Timestamp jitter over {:.0f} us in {} frames, maximum {:.1f} us.".format(
+            self.jitter_tolerance * self.interval, self.jitter_count, self.max_jitter))
+
+
+def log_filename(output_file):
+    """Metadata log is saved next to the recording. For raw frame stores it is the index of the
+    store."""
+    return index_filename(output_file)
+
+
+class SimulatedCamera:
+    """Grab source generating frames at the frame rate without camera. Metadata is (counter,
+    timestamp in us, exposure time in us) as from the camera chunks."""
+
+    def __init__(self, width=160, height=160, fps=500.0, frame_count=None, exposure_time=1000.0,
+                 channels=1):
+        self.fps = fps
+        self.frame_count = frame_count # None for grabbing until stopped
+        self.exposure_time = exposure_time
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        # Moving gradient, so the frames differ
+        self.pattern = np.tile(np.arange(width + 256, dtype=np.uint8), (height, 1))
+        if channels > 1:
+            self.pattern = np.repeat(self.pattern[:, :, None], channels, axis=2)
+        self.shape = shape
+        self.counter = 0
+        self.start_time = None
+        self.stopped = False
+
+    def grab(self):
+        """Waits for the next frame time and returns the frame and its metadata."""
+        if self.stopped or (self.frame_count is not None and self.counter >= self.frame_count):
+            return None
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        delay = self.start_time + self.counter / self.fps - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        offset = self.counter % 256
+        image = self.pattern[:, offset:offset + self.shape[1]]
+        self.counter += 1
+        timestamp = round((self.counter - 1) / self.fps * 1e6, 2)
+        return image, (self.counter, timestamp, self.exposure_time)
+
+    def stop(self):
+        self.stopped = True
+
+
+class OpenCVWriter:
+    """Video writer with the writeFrame interface of skvideo.io.FFmpegWriter using OpenCV. Frames
+    are RGB or grayscale as for skvideo."""
+
+    def __init__(self, filename, fps, size, fourcc='MJPG', color=True):
+        self.output = cv.VideoWriter(str(filename), cv.VideoWriter_fourcc(*fourcc), fps, size,
+                                     color)
+        self.color = color
+
+    def writeFrame(self, image):
+        if self.color and image.ndim == 3:
+            image = cv.cvtColor(image, cv.COLOR_RGB2BGR)
+        self.output.write(image)
+
+    def close(self):
+        self.output.release()
+
+
+class SlowWriter:
+    """Writer wrapper adding a delay to every frame for simulating encoder stalls. Metadata is
+    passed to writers accepting it."""
+
+    def __init__(self, writer, delay):
+        self.writer = writer
+        self.delay = delay # Seconds
+        self.accepts_metadata = getattr(writer, 'accepts_metadata', False)
+
+    def writeFrame(self, image, metadata=None):
+        time.sleep(self.delay)
+        if self.accepts_metadata:
+            self.writer.writeFrame(image, metadata)
+        elif self.writer is not None:
+            self.writer.writeFrame(image)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def main():
+    """Records simulated camera for testing the pipeline without camera."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='define output video (MJPG avi or raw frame store '
+                                               'with .raw), not saved if not given')
+    parser.add_argument('-n', '--frames', type=int, default=5000, help='frames to record')
+    parser.add_argument('--fps', type=float, default=500.0, help='frame rate of the camera')
+    parser.add_argument('--size', type=int, nargs=2, default=(160, 160), metavar=('WIDTH', 'HEIGHT'),
+                        help='frame size')
+    parser.add_argument('--ring', type=int, default=1000, help='ring buffer size in frames')
+    parser.add_argument('--encode-delay', type=float, default=0.0,
+                        help='extra delay in ms for writing each frame, simulates encoder stalls')
+    args = parser.parse_args()
+
+    source = SimulatedCamera(args.size[0], args.size[1], args.fps, args.frames)
+    writer = None
+    if args.output and args.output.endswith('.raw'):
+        # Metadata log is the index of the store
+        writer = FrameStoreWriter(args.output, (args.size[1], args.size[0]), args.fps, args.frames,
+                                  index=False)
+    elif args.output:
+        writer = OpenCVWriter(args.output, args.fps, tuple(args.size), color=False)
+    if args.encode_delay > 0:
+        writer = SlowWriter(writer, args.encode_delay / 1000)
+    log = MetadataLog(log_filename(args.output), args.fps) if args.output else None
+    pipeline = RecordingPipeline(source, writer, args.ring, log)
+    start = time.perf_counter()
+    try:
+        pipeline.run()
+    finally:
+        if writer is not None:
+            writer.close()
+        if log is not None:
+            log.close()
+    duration = time.perf_counter() - start
+    print("Recorded {} frames in {:.1f} s ({:.0f} fps)".format(pipeline.written, duration,
+                                                             pipeline.written / duration))
+    if log is not None:
+        log.print_summary()
+    if pipeline.dropped:
+        sys.exit("Dropped {} frames!".format(pipeline.dropped))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Writers for the eyeblink analysis results."""
+import csv
+import struct
+import time
+import numpy as np
+from pathlib import Path
+from utils import Parameters
+
+
+class BatchWriter:
+    """Base of the writers streaming rows to a file while analyzing or recording. Rows are written
+    in batches and the file is flushed periodically, so memory use stays flat and a crash loses
+    only the last rows. Output is opened on the first batch. Subclasses write the output with open,
+    write_batch, flush_output, close_output and position."""
+
+    def __init__(self, filename, batch_size=1000, flush_interval=5.0):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # Seconds
+        self.rows = []
+        self.opened = False
+        self.row_count = 0
+        self.last_flush = time.monotonic()
+
+    def open(self, position=None):
+        """Opens new output, or continues existing output from the position returned by
+        position."""
+        raise NotImplementedError
+
+    def write_batch(self, rows):
+        """Writes rows to the open output."""
+        raise NotImplementedError
+
+    def flush_output(self):
+        """Flushes the open output to the disk."""
+        raise NotImplementedError
+
+    def close_output(self):
+        """Closes the open output."""
+        raise NotImplementedError
+
+    def position(self):
+        """Returns position of the output for continuing it with resume."""
+        raise NotImplementedError
+
+    def append(self, row):
+        """Adds row to the output."""
+        self.rows.append(row)
+        self.row_count += 1
+        if len(self.rows) >= self.batch_size:
+            self.write_rows()
+
+    def extend(self, rows):
+        """Adds many rows to the output."""
+        for row in rows:
+            self.append(row)
+
+    def write_rows(self):
+        """Writes the batch of rows and flushes the output if flush interval has passed."""
+        if not self.opened:
+            self.open()
+            self.opened = True
+        self.write_batch(self.rows)
+        self.rows = []
+        if time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Flushes written rows to the disk."""
+        if self.opened:
+            self.flush_output()
+        self.last_flush = time.monotonic()
+
+    def sync(self):
+        """Writes all rows to the disk. Returns position for continuing the output with resume."""
+        if self.rows:
+            self.write_rows()
+        self.flush()
+        return self.position()
+
+    def resume(self, position, row_count):
+        """Continues existing output from the position returned by sync. Rows written after it
+        are removed."""
+        self.open(position)
+        self.opened = True
+        self.row_count = row_count
+
+    def close(self):
+        """Writes remaining rows and closes the output. Nothing is written if there are no
+        rows."""
+        if self.rows:
+            self.write_rows()
+        if self.opened:
+            self.close_output()
+            self.opened = False
+
+    def __len__(self):
+        return self.row_count
+
+
+class CsvResultWriter(BatchWriter):
+    """Writes analysis results to CSV file while the video is analyzed, see BatchWriter."""
+
+    def __init__(self, filename, batch_size=1000, flush_interval=5.0):
+        super().__init__(filename, batch_size, flush_interval)
+        self.file = None
+        self.writer = None
+
+    def open(self, position=None):
+        """Opens output file. With position existing file is truncated and continued there."""
+        if position is None:
+            self.file = open(self.filename, 'w', newline='')
+        else:
+            self.file = open(self.filename, 'r+', newline='')
+            self.file.truncate(position)
+            self.file.seek(position)
+        self.writer = csv.writer(self.file)
+
+    def write_batch(self, rows):
+        self.writer.writerows(rows)
+
+    def flush_output(self):
+        self.file.flush()
+
+    def close_output(self):
+        self.file.close()
+        self.file = None
+
+    def position(self):
+        """Position in the file."""
+        return self.file.tell() if self.file is not None else 0
+
+
+class NpyAppender:
+    """Appends rows to a NumPy .npy file. Header has fixed length, so it can be rewritten with the
+    current row count on every flush. File can be loaded (or memory-mapped) with numpy.load after
+    each flush."""
+
+    header_length = 128
+
+    def __init__(self, filename, dtype, shape=(), length=None):
+        """Accepts dtype of the rows and shape of one row. With length existing file is continued
+        after that many rows."""
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        # Longer header for structured dtypes. Fits any row count, padded to 64 bytes as in NumPy.
+        longest = len(self.header_text(2 ** 63)) + 11
+        self.header_length = max(NpyAppender.header_length, (longest + 63) // 64 * 64)
+        if length is None:
+            self.length = 0
+            self.file = open(self.filename, 'wb')
+            self.write_header()
+        else:
+            self.length = length
+            self.file = open(self.filename, 'r+b')
+            self.file.truncate(self.header_length
+                               + length * self.dtype.itemsize * int(np.prod(self.shape)))
+            self.file.seek(0, 2)
+            self.write_header()
+
+    def header_text(self, length):
+        """Returns npy header dictionary for the row count."""
+        return "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(self.dtype), (length,) + self.shape)
+
+    def write_header(self):
+        """Writes npy header for the current row count to the beginning of the file."""
+        # Magic string and version take 8 bytes and header length 2 bytes
+        header = self.header_text(self.length).ljust(self.header_length - 11) + '\n'
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(np.lib.format.magic(1, 0) + struct.pack('<H', len(header)))
+        self.file.write(header.encode('latin1'))
+        if position > 0:
+            self.file.seek(position)
+
+    def append(self, rows):
+        """Appends array of rows."""
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape((-1,) + self.shape)
+        self.file.write(rows.tobytes())
+        self.length += len(rows)
+
+    def flush(self):
+        """Updates header and flushes the file to the disk."""
+        self.write_header()
+        self.file.flush()
+
+    def close(self):
+        """Updates header and closes the file."""
+        if self.file is not None:
+            self.write_header()
+            self.file.close()
+            self.file = None
+
+
+class NpyResultWriter(BatchWriter):
+    """Writes analysis results as columns to a directory of .npy files: frame_num, frame_time and
+    count. Parameters used in the analysis are saved to the same directory. Columns can be memory
+    mapped with load_results instead of parsing text."""
+
+    columns = (('frame_num', np.int64), ('frame_time', np.float64), ('count', np.int64))
+
+    def __init__(self, directory, params=None, batch_size=1000, flush_interval=5.0):
+        super().__init__(Path(directory), batch_size, flush_interval)
+        self.params = params
+        self.appenders = None
+
+    def open(self, position=None):
+        """Creates output directory, column files and saves parameters. With position (row count)
+        existing columns are continued after that many rows."""
+        self.filename.mkdir(parents=True, exist_ok=True)
+        self.appenders = [NpyAppender(self.filename / (name + '.npy'), dtype, length=position)
+                          for name, dtype in self.columns]
+        if self.params is not None:
+            Parameters(self.filename / 'parameters.prm', dict(self.params)).save_parameters()
+
+    def write_batch(self, rows):
+        for i, appender in enumerate(self.appenders):
+            appender.append([row[i] for row in rows])
+
+    def flush_output(self):
+        for appender in self.appenders:
+            appender.flush()
+
+    def close_output(self):
+        for appender in self.appenders:
+            appender.close()
+        self.appenders = None
+
+    def position(self):
+        """Row count of the columns."""
+        return self.row_count
+
+
+def load_results(directory, mmap=True):
+    """Loads results written by NpyResultWriter. Columns are memory-mapped by default. Parameters
+    are returned with the 'parameters' key, if saved."""
+    directory = Path(directory)
+    results = {}
+    for name, dtype in NpyResultWriter.columns:
+        results[name] = np.load(directory / (name + '.npy'), mmap_mode='r' if mmap else None)
+    parameters_file = directory / 'parameters.prm'
+    if parameters_file.exists():
+        params = Parameters(parameters_file, dict())
+        params.load_parameters()
+        results['parameters'] = params.params
+    return results
@@ -0,0 +1,46 @@
+"""Threshold sweep from the per-frame histograms of the thresholds at which the pixels of the
+filtered eye area turn white. White pixel counts of every threshold are computed from the
+histograms, so the video is decoded only once."""
+import numpy as np
+from pathlib import Path
+from results import NpyAppender
+
+# Frames of the histograms processed at once
+BLOCK_FRAMES = 10000
+
+
+def threshold_counts(histograms, thresholds=None):
+    """Returns white pixel counts (frames x thresholds) from the histograms (frames x 256) of the
+    thresholds at which the pixels turn white, see LuminanceFiltering.white_thresholds. Pixel is
+    white at its threshold and above. Analysis leaves the frame unthresholded with the threshold
+    0, so the counts of the threshold 0 are not the same as in the analysis."""
+    histograms = np.asarray(histograms)
+    counts = np.cumsum(histograms, axis=1)
+    if thresholds is not None:
+        counts = counts[:, thresholds]
+    return counts
+
+
+def suggest_threshold(histograms):
+    """Suggests threshold with Otsu's method from the histogram of all the frames. Threshold splits
+    pixels to white (turning white up to the threshold) and black with the maximum between class
+    variance."""
+    histogram = np.zeros(256)
+    for start in range(0, len(histograms), BLOCK_FRAMES):
+        histogram += np.sum(histograms[start:start + BLOCK_FRAMES], axis=0)
+    values = np.arange(256)
+    weight = np.cumsum(histogram)
+    total = weight[-1]
+    mean = np.cumsum(histogram * values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = (mean[-1] * weight - mean * total) ** 2 / (weight * (total - weight))
+    variance = np.nan_to_num(variance[1:255])
+    return int(np.argmax(variance)) + 1
+
+
+def save_sweep(directory, histograms):
+    """Saves counts of all the thresholds (frames x 256) to the directory as counts.npy."""
+    appender = NpyAppender(Path(directory) / 'counts.npy', np.uint32, (256,))
+    for start in range(0, len(histograms), BLOCK_FRAMES):
+        appender.append(threshold_counts(histograms[start:start + BLOCK_FRAMES]))
+    appender.close()
@@ -1,7 +1,9 @@
 import cv2 as cv
 import numpy as np
 import copy
+import time
 from frame import Frame
+from profiling import profiled
 
 # TODO: select the closest of the detected points. Fix jumping bounding box.
 # TODO: Keep constant bounding box size
@@ -11,10 +13,21 @@ from frame import Frame
 """Handles object detection, tracking and related functions."""
 class Tracking:
 
+    # Loaded cascade classifiers by cascade file. Shared by all instances, and in worker processes
+    # loaded once per process.
+    cascades = {}
+    # Time spent loading cascades and detecting with them
+    stats = {'load_count': 0, 'load_time': 0.0, 'detect_count': 0, 'detect_time': 0.0}
+
     def __init__(self, frame=None):
         self.frame = frame
         self.initial_frame = frame
         self.tracking_points = {}
+        self.frames_since_full = 0
+        self.frames_lost = 0 # Frames the restricted search has not found the eye
+        self.frames_since_key = 0
+        self.template = None
+        self.confidence = 0.0
 
     # Optical flow (not in use, experimental and work in progress)
     def point_tracking(self, points=None, **kwargs):
@@ -30,6 +43,7 @@ class Tracking:
         self.set_tracking_point('flow', points)
 
 
+    @profiled
     def haar_classifier(self, **kwargs):
         """Detects eye with haar classifier."""
         # Default settings for haar cascade classifier
@@ -62,13 +76,166 @@ class Tracking:
         if 'maxMovement' in kwargs:
             maxMovement = kwargs['maxMovement']
 
-        cascade = cv.CascadeClassifier(cascade_file)
+        cascade = self.get_cascade(cascade_file)
+        detected = self._detect(cascade, frame, scaleFactor, minNeighbors, minSize, maxSize)
+        self._update_point(detected, name, select, maxMovement)
+        return len(detected) > 0
+
+    @profiled
+    def haar_roi_classifier(self, **kwargs):
+        """Detects eye with haar classifier only near the last detected location and size. Search
+        window is downscaled before detection. Full frame is searched every refreshInterval frames
+        and when the eye is lost, but only every lostInterval frames while it stays lost (e.g.
+        closed during a blink). Other arguments are passed to haar_classifier for the full frame
+        search."""
+        # Default settings for restricted search
+        searchMargin = 32 # Pixels around the last location
+        sizeMargin = 0.25 # Relative change of the size from the last size
+        downscale = 0.5
+        refreshInterval = 100
+        lostInterval = 10
+        # Window has only few scales to go through, so coarser settings than in the full search
+        roiScaleFactor = 1.05
+        roiMinNeighbors = 10
+        select = 0
+        name = 'haar'
+        maxMovement = 16
+
+        if 'searchMargin' in kwargs:
+            searchMargin = kwargs.pop('searchMargin')
+        if 'sizeMargin' in kwargs:
+            sizeMargin = kwargs.pop('sizeMargin')
+        if 'downscale' in kwargs:
+            downscale = kwargs.pop('downscale')
+        if 'refreshInterval' in kwargs:
+            refreshInterval = kwargs.pop('refreshInterval')
+        if 'lostInterval' in kwargs:
+            lostInterval = kwargs.pop('lostInterval')
+        if 'roiScaleFactor' in kwargs:
+            roiScaleFactor = kwargs.pop('roiScaleFactor')
+        if 'roiMinNeighbors' in kwargs:
+            roiMinNeighbors = kwargs.pop('roiMinNeighbors')
+        if 'select' in kwargs:
+            select = kwargs['select'] - 1
+        if 'name' in kwargs:
+            name = kwargs['name']
+        if 'maxMovement' in kwargs:
+            maxMovement = kwargs['maxMovement']
+        if 'cascadeFile' not in kwargs:
+            raise RuntimeError('Cascade file not defined!')
+
+        prev_point = self.get_tracking_point(name)
+        self.frames_since_full += 1
+        if not prev_point or self.frames_since_full >= refreshInterval:
+            self.frames_since_full = 0
+            return self.haar_classifier(**kwargs)
+
+        frame = self.frame.frame
+        cascade = self.get_cascade(kwargs['cascadeFile'])
+
+        # Search window around the last location, kept inside the frame
+        x = max(prev_point['x'] - searchMargin, 0)
+        y = max(prev_point['y'] - searchMargin, 0)
+        xw = min(prev_point['x'] + prev_point['w'] + searchMargin, frame.shape[1])
+        yh = min(prev_point['y'] + prev_point['h'] + searchMargin, frame.shape[0])
+
+        # Downscaling is limited so that the eye is not smaller than the cascade window
+        size = min(prev_point['w'], prev_point['h'])
+        scale = min(max(downscale, cascade.getOriginalWindowSize()[0] / (size * (1 - sizeMargin))), 1)
+        window = cv.resize(frame[y:yh, x:xw], None, fx=scale, fy=scale,
+                           interpolation=cv.INTER_AREA)
+        minSize = (int(prev_point['w'] * (1 - sizeMargin) * scale),
+                   int(prev_point['h'] * (1 - sizeMargin) * scale))
+        maxSize = (int(prev_point['w'] * (1 + sizeMargin) * scale) + 1,
+                   int(prev_point['h'] * (1 + sizeMargin) * scale) + 1)
+        detected = self._detect(cascade, window, roiScaleFactor, roiMinNeighbors, minSize, maxSize)
+
+        if len(detected) == 0:
+            # Eye lost, searching the whole frame. Last location is kept between the searches.
+            self.frames_lost += 1
+            if (self.frames_lost - 1) % lostInterval == 0:
+                self.frames_since_full = 0
+                return self.haar_classifier(**kwargs)
+            return False
+
+        self.frames_lost = 0
+        # Back to the full frame coordinates
+        detected = np.round(np.asarray(detected) / scale).astype(int) + (x, y, 0, 0)
+        self._update_point(detected, name, select, maxMovement)
+        return True
+
+    @profiled
+    def template_tracking(self, **kwargs):
+        """Tracks eye with template matching between haar detections. Template is taken from the
+        detected eye on keyframes and searched near the last location on the frames between. Box
+        size stays the same between keyframes. Eye is detected again every keyframeInterval frames
+        and when the match confidence drops below minConfidence. Other arguments are passed to
+        haar_roi_classifier."""
+        # Default settings for template tracking
+        keyframeInterval = 250
+        minConfidence = 0.7
+        searchMargin = 16
+        name = 'haar'
+
+        if 'keyframeInterval' in kwargs:
+            keyframeInterval = kwargs.pop('keyframeInterval')
+        if 'minConfidence' in kwargs:
+            minConfidence = kwargs.pop('minConfidence')
+        if 'templateMargin' in kwargs:
+            searchMargin = kwargs.pop('templateMargin')
+        if 'name' in kwargs:
+            name = kwargs['name']
+
+        frame = self.frame.frame
+        if frame.ndim == 3:
+            frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+        point = self.get_tracking_point(name)
+        self.frames_since_key += 1
+        if (self.template is None or not point or self.frames_since_key >= keyframeInterval
+                or self.confidence < minConfidence):
+            # Keyframe, detecting eye and taking new template
+            self.frames_since_key = 0
+            found = self.haar_roi_classifier(**kwargs)
+            point = self.get_tracking_point(name)
+            if found and point:
+                self.template = frame[point['y']:point['y'] + point['h'],
+                                      point['x']:point['x'] + point['w']].copy()
+                self.confidence = 1.0
+            return found
+
+        # Search window around the last location, kept inside the frame
+        x = max(point['x'] - searchMargin, 0)
+        y = max(point['y'] - searchMargin, 0)
+        xw = min(point['x'] + point['w'] + searchMargin, frame.shape[1])
+        yh = min(point['y'] + point['h'] + searchMargin, frame.shape[0])
+        window = frame[y:yh, x:xw]
+        if window.shape[0] < self.template.shape[0] or window.shape[1] < self.template.shape[1]:
+            self.confidence = 0.0
+            return False
+
+        result = cv.matchTemplate(window, self.template, cv.TM_CCOEFF_NORMED)
+        ret, self.confidence, ret, location = cv.minMaxLoc(result)
+        if self.confidence < minConfidence:
+            # Keeps the last location, eye is detected again on the next frame
+            return False
+        self.set_tracking_point(name, {'x': x + location[0], 'y': y + location[1],
+                                       'w': point['w'], 'h': point['h']})
+        return True
+
+    def _detect(self, cascade, frame, scaleFactor, minNeighbors, minSize, maxSize):
+        """Runs the cascade and updates detection counters."""
+        start = time.perf_counter()
         detected = cascade.detectMultiScale(frame, scaleFactor=scaleFactor,
                                             minNeighbors=minNeighbors,
                                             minSize=minSize,
                                             maxSize=maxSize)
+        Tracking.stats['detect_count'] += 1
+        Tracking.stats['detect_time'] += time.perf_counter() - start
+        return detected
 
-        # Updates tracking point if new point detected
+    def _update_point(self, detected, name, select, maxMovement):
+        """Updates tracking point if new point detected."""
         if detected is not None and len(detected) > 0:
             prev_point = self.get_tracking_point(name)
             new_point = {'x': detected[select][0], 'y': detected[select][1],
@@ -83,7 +250,24 @@ class Tracking:
             else:
                 self.set_tracking_point(name, new_point)
 
+    @classmethod
+    def get_cascade(cls, cascade_file):
+        """Returns cascade classifier for the file. File is loaded only on the first call."""
+        cascade_file = str(cascade_file)
+        if cascade_file not in cls.cascades:
+            start = time.perf_counter()
+            cascade = cv.CascadeClassifier(cascade_file)
+            if cascade.empty():
+                raise RuntimeError('Cascade file could not be loaded!')
+            cls.cascades[cascade_file] = cascade
+            cls.stats['load_count'] += 1
+            cls.stats['load_time'] += time.perf_counter() - start
+        return cls.cascades[cascade_file]
 
+    @classmethod
+    def get_stats(cls):
+        """Returns copy of the cascade load and detection counters."""
+        return dict(cls.stats)
 
     def _distance(self, point1, point2):
         """Manhattan distance for comparing point distances."""
@@ -55,7 +55,7 @@ class VideoWindow:
         self.video_2 = None
 
     def ask_file(self, file_title):
-        return tk.filedialog.askopenfile(title = "file_title", filetypes = (("video files","*.avi *.mp4 *.mkv *.mpeg"),("all files","*.*"))).name
+        return tk.filedialog.askopenfile(title = "file_title", filetypes = (("video files","*.avi *.mp4 *.mkv *.mpeg *.raw"),("all files","*.*"))).name
 
     def close_app(self):
         self.window.destroy()
@@ -64,12 +64,17 @@ class VideoWindow:
     def get_status(self):
         return self.status
 
+    def to_rgba(self, frame):
+        if frame.ndim == 2:
+            return cv.cvtColor(frame, cv.COLOR_GRAY2RGBA)
+        return cv.cvtColor(frame, cv.COLOR_BGR2RGBA)
+
     def add_video_frame_left(self, frame, size):
         self.frame = frame
         self.width = size[1]
         self.height = size[0]
 
-        self.frame = cv.cvtColor(frame, cv.COLOR_BGR2RGBA)
+        self.frame = self.to_rgba(frame)
         self.img = ImageTk.PhotoImage(image = Image.fromarray(self.frame))
 
         if self.video_1 is None:
@@ -86,7 +91,7 @@ class VideoWindow:
         self.width = size[1]
         self.height = size[0]
 
-        self.frame = cv.cvtColor(frame, cv.COLOR_BGR2RGBA)
+        self.frame = self.to_rgba(frame)
         self.img = ImageTk.PhotoImage(image = Image.fromarray(self.frame))
 
         if self.video_2 is None:
@@ -1,4 +1,5 @@
 """Utils for blinky eyeblink detector."""
+import time
 from configparser import ConfigParser
 
 class Parameters:
@@ -19,3 +20,25 @@ class Parameters:
         config['Parameters'] = self.params
         with open(self.filename, 'w') as configfile:
             config.write(configfile)
+
+
+class RateLimiter:
+    """Limits how often something is done, e.g. updating the GUI. ready returns True at most rate
+    times per second."""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
+
+    def ready(self):
+        now = time.perf_counter()
+        if now < self.next_time:
+            return False
+        self.next_time = now + self.interval
+        return True
+
+    def wait(self):
+        """Sleeps until ready and takes the turn."""
+        delay = self.next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.ready()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Modules are run from src, see README
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
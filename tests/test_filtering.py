@@ -0,0 +1,89 @@
+"""White pixel counts of LuminanceFiltering against the reference VideoFiltering."""
+from pathlib import Path
+import cv2 as cv
+import pytest
+from filtering import VideoFiltering, LuminanceFiltering
+from frame import Frame
+from tracking import Tracking
+
+ROOT = Path(__file__).resolve().parent.parent
+VIDEO = ROOT / 'sample_video.avi'
+CASCADE = ROOT / 'src' / 'haar_cascades' / 'haarcascade_eye.xml'
+FRAME_COUNT = 300
+
+# Defaults of blinky_app and a darker, lower contrast setting
+PARAMETERS = [
+    {'b_val': 118, 'c_val': 61, 'thres_val': 85, 'blur_val': 3, 'pad_val': 12,
+     'area_x': 160, 'area_y': 160},
+    {'b_val': 40, 'c_val': 10, 'thres_val': 150, 'blur_val': 0, 'pad_val': 0,
+     'area_x': 100, 'area_y': 80},
+]
+
+
+@pytest.fixture(scope='module')
+def frames():
+    """Frames of the sample video and the eye area of the first frame."""
+    if not VIDEO.exists():
+        pytest.skip("sample_video.avi not found")
+    capture = cv.VideoCapture(str(VIDEO))
+    frames = []
+    while len(frames) < FRAME_COUNT:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+    capture.release()
+    tracker = Tracking(Frame(frames[0]))
+    tracker.haar_classifier(cascadeFile=str(CASCADE))
+    haar_pt = tracker.get_tracking_point('haar')
+    assert haar_pt, "Eye not found from the first frame"
+    return frames, haar_pt
+
+
+def reference_count(frame, haar_pt, params):
+    filt = VideoFiltering(Frame(frame.copy()))
+    filt.crop_roi(haar_pt, params['pad_val'])
+    filt.blur((params['blur_val'], params['blur_val']))
+    filt.brightness_contrast(params['b_val'], params['c_val'])
+    filt.threshold(params['thres_val'])
+    filt.resize((params['area_x'], params['area_y']))
+    return filt.frequencies()
+
+
+@pytest.mark.parametrize('params', PARAMETERS)
+def test_luminance_counts_match_reference(frames, params):
+    frames, haar_pt = frames
+    filt = LuminanceFiltering()
+    for frame in frames:
+        filt.frame = Frame(frame)
+        filt.crop_roi(haar_pt, params['pad_val'])
+        filt.luminance()
+        filt.blur((params['blur_val'], params['blur_val']))
+        filt.brightness_contrast(params['b_val'], params['c_val'])
+        filt.threshold(params['thres_val'])
+        filt.resize((params['area_x'], params['area_y']))
+        assert filt.frequencies() == reference_count(frame, haar_pt, params)
+
+
+@pytest.mark.parametrize('params', PARAMETERS)
+def test_lut_threshold_counts_match_reference(frames, params):
+    frames, haar_pt = frames
+    filt = LuminanceFiltering()
+    for frame in frames:
+        filt.frame = Frame(frame)
+        filt.crop_roi(haar_pt, params['pad_val'])
+        filt.luminance()
+        filt.blur((params['blur_val'], params['blur_val']))
+        filt.lut_threshold(params['b_val'], params['c_val'], params['thres_val'])
+        filt.resize((params['area_x'], params['area_y']))
+        assert filt.frequencies() == reference_count(frame, haar_pt, params)
+
+
+@pytest.mark.parametrize('params', PARAMETERS)
+def test_process_counts_match_reference(frames, params):
+    frames, haar_pt = frames
+    filt = LuminanceFiltering()
+    for frame in frames:
+        filt.frame = Frame(frame)
+        filt.process(params, haar_pt)
+        assert filt.frequencies() == reference_count(frame, haar_pt, params)
@@ -0,0 +1,84 @@
+"""Recording pipeline with the simulated camera and a slow raw frame store writer."""
+import numpy as np
+import pytest
+from framestore import FrameStoreWriter, RawCapture
+from recording import RecordingPipeline, MetadataLog, SimulatedCamera, SlowWriter, log_filename
+
+FRAME_COUNT = 300
+FPS = 2000.0
+SHAPE = (24, 32)
+
+
+class FailingWriter:
+    """Writer failing after given frames, like with a full disk."""
+
+    accepts_metadata = True
+
+    def __init__(self, writer, frames):
+        self.writer = writer
+        self.frames = frames
+
+    def writeFrame(self, image, metadata=None):
+        if self.writer.count >= self.frames:
+            raise IOError("Disk full")
+        self.writer.writeFrame(image, metadata)
+
+    def close(self):
+        self.writer.close()
+
+
+def record(store, writer, ring_size=4):
+    source = SimulatedCamera(SHAPE[1], SHAPE[0], FPS, FRAME_COUNT)
+    log = MetadataLog(log_filename(store), FPS)
+    pipeline = RecordingPipeline(source, writer, ring_size, log)
+    try:
+        pipeline.run()
+    finally:
+        writer.close()
+        log.close()
+    return pipeline, log
+
+
+def test_dropped_frames_are_logged_as_gaps(tmp_path):
+    store = tmp_path / 'recording.raw'
+    # Encoder is slower than the camera, so the small ring fills up
+    writer = SlowWriter(FrameStoreWriter(store, SHAPE, FPS, FRAME_COUNT, index=False), 0.002)
+    pipeline, log = record(store, writer)
+
+    stats = pipeline.stats()
+    assert stats['grabbed'] == FRAME_COUNT
+    assert stats['dropped'] > 0
+    assert stats['written'] + stats['dropped'] == stats['grabbed']
+
+    counters = np.load(log_filename(store))['counter']
+    assert len(counters) == stats['written']
+    # Frames dropped after the last written frame are not between the logged counters
+    assert log.dropped == sum(missing for before, after, missing in log.gaps)
+    assert log.dropped + FRAME_COUNT - counters[-1] == stats['dropped']
+
+    cap = RawCapture(str(store))
+    frames = 0
+    while cap.capture_frame() is not None:
+        # Simulated frames are numbered by their first pixel
+        assert cap.frame.frame[0, 0] == (counters[frames] - 1) % 256
+        frames += 1
+    assert frames == stats['written']
+
+
+def test_failed_frames_are_not_counted(tmp_path):
+    store = tmp_path / 'recording.raw'
+    writer = FailingWriter(FrameStoreWriter(store, SHAPE, FPS, FRAME_COUNT, index=False), 50)
+    log = MetadataLog(log_filename(store), FPS)
+    pipeline = RecordingPipeline(SimulatedCamera(SHAPE[1], SHAPE[0], FPS, FRAME_COUNT), writer,
+                                 FRAME_COUNT, log)
+    with pytest.raises(IOError):
+        pipeline.run()
+    writer.close()
+    log.close()
+
+    stats = pipeline.stats()
+    assert stats['written'] == 50
+    assert stats['failed'] > 0
+    assert stats['written'] + stats['dropped'] + stats['failed'] == stats['grabbed']
+    assert len(np.load(log_filename(store))) == 50
+    assert RawCapture(str(store)).get_total_frames() == 50
@@ -0,0 +1,59 @@
+"""White pixel counts of the threshold sweep against the analysis."""
+from pathlib import Path
+import cv2 as cv
+import numpy as np
+import pytest
+import blinky_app
+from frame import Frame
+from tracking import Tracking
+
+ROOT = Path(__file__).resolve().parent.parent
+VIDEO = ROOT / 'sample_video.avi'
+CASCADE = ROOT / 'src' / 'haar_cascades' / 'haarcascade_eye.xml'
+FRAME_COUNT = 200
+THRESHOLDS = [1, 40, 85, 150, 254]
+
+# Defaults of blinky_app and a darker, lower contrast setting
+PARAMETERS = [
+    dict(blinky_app.DEFAULT_PARAMETERS),
+    {'b_val': 40, 'c_val': 10, 'thres_val': 150, 'blur_val': 0, 'pad_val': 0,
+     'area_x': 100, 'area_y': 80, 'const_track': 0},
+]
+
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    """Short clip of the sample video and the eye area of its first frame."""
+    if not VIDEO.exists():
+        pytest.skip("sample_video.avi not found")
+    capture = cv.VideoCapture(str(VIDEO))
+    clip = tmp_path_factory.mktemp('sweep') / 'clip.avi'
+    writer = None
+    for i in range(FRAME_COUNT):
+        ret, frame = capture.read()
+        if not ret:
+            break
+        if writer is None:
+            writer = cv.VideoWriter(str(clip), cv.VideoWriter_fourcc(*'MJPG'),
+                                    capture.get(cv.CAP_PROP_FPS),
+                                    (frame.shape[1], frame.shape[0]))
+            tracker = Tracking(Frame(frame))
+            tracker.haar_classifier(cascadeFile=str(CASCADE))
+            haar_pt = tracker.get_tracking_point('haar')
+        writer.write(frame)
+    writer.release()
+    capture.release()
+    assert haar_pt, "Eye not found from the first frame"
+    return clip, haar_pt
+
+
+@pytest.mark.parametrize('params', PARAMETERS)
+def test_sweep_counts_match_analysis(video, tmp_path, params):
+    clip, haar_pt = video
+    blinky_app.sweep_thresholds(clip, params, CASCADE, haar_pt, tmp_path)
+    counts = np.load(tmp_path / 'counts.npy')
+    for threshold in THRESHOLDS:
+        rows = blinky_app.analyze_chunk(clip, dict(params, thres_val=threshold), CASCADE, haar_pt,
+                                        24, None)
+        assert len(rows) == len(counts)
+        assert np.array_equal(counts[:, threshold], [row[2] for row in rows])